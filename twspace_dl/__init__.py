@@ -1,6 +1,16 @@
 from .api import API
 from .cookies import load_cookies
+from .postprocess import PostProcessor
+from .stream import AudioSegment, SegmentStream
 from .twspace import Twspace
 from .twspace_dl import TwspaceDL
 
-__all__ = ["API", "load_cookies", "Twspace", "TwspaceDL"]
+__all__ = [
+    "API",
+    "AudioSegment",
+    "load_cookies",
+    "PostProcessor",
+    "SegmentStream",
+    "Twspace",
+    "TwspaceDL",
+]
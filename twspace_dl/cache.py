@@ -0,0 +1,195 @@
+"""Content-addressed cache of downloaded segments, shared between processes"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import uuid
+from typing import Callable
+
+"""Default maximum total size of the cache in bytes."""
+DEFAULT_CACHE_SIZE = 1024**3
+
+"""Seconds after which the lock of a segment is considered abandoned."""
+LOCK_TIMEOUT = 60
+
+"""Seconds to wait between checks while another process is fetching a segment."""
+LOCK_POLL_INTERVAL = 0.1
+
+"""Minimum number of seconds between two eviction passes."""
+EVICT_INTERVAL = 10
+
+
+class SegmentCache:
+    """Cache of segments on disk, keyed by master URL and segment name.
+
+    Processes sharing the same directory fetch each segment only once: the first one
+    to need a segment takes a lock file while downloading it, the others wait for the
+    segment to appear. The least recently used segments are evicted when the total
+    size of the cache exceeds `max_size`.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        """Initialize the cache.
+
+        - directory: The directory to store the segments in, created if missing.
+        - max_size: The maximum total size of the cached segments in bytes.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._last_eviction = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(master_url: str, name: str) -> str:
+        """Compute the cache key of a segment.
+
+        - master_url: The master playlist URL of the space, without query string.
+        - name: The file name of the segment.
+
+        - return: The hex digest identifying the segment.
+        """
+        master_url = master_url.split("?", 1)[0]
+        return hashlib.sha256(f"{master_url}\n{name}".encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """Return the path of the file storing the segment with the specified key."""
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read(self, path: str) -> bytes | None:
+        try:
+            with open(path, "rb") as segment_io:
+                data = segment_io.read()
+        except FileNotFoundError:
+            return None
+        # the modification time tracks the last use for the LRU eviction
+        os.utime(path)
+        return data
+
+    def _lock(self, path: str) -> str | None:
+        """Try to take the lock of a segment, breaking it if it was abandoned.
+
+        The lock file holds a token of its owner, so that a lock broken while its
+        owner was still fetching, and taken again by another process, isn't
+        removed by the previous owner.
+
+        - return: The token of the lock if it was taken, `None` if another process
+          holds it.
+        """
+        lock_path = path + ".lock"
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            owner = self._lock_owner(lock_path)
+            try:
+                stale = time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT
+            except FileNotFoundError:
+                return None
+            if stale and owner is not None:
+                logging.debug("Breaking stale lock %s", lock_path)
+                self._unlock(path, owner)
+            return None
+        with os.fdopen(fd, "w", encoding="utf-8") as lock_io:
+            lock_io.write(token)
+        return token
+
+    @staticmethod
+    def _lock_owner(lock_path: str) -> str | None:
+        try:
+            with open(lock_path, "r", encoding="utf-8") as lock_io:
+                return lock_io.read()
+        except FileNotFoundError:
+            return None
+
+    def _unlock(self, path: str, token: str) -> None:
+        """Remove the lock of a segment if it is still owned by the token."""
+        lock_path = path + ".lock"
+        if self._lock_owner(lock_path) != token:
+            logging.debug("Lock %s was broken and taken over", lock_path)
+            return
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, master_url: str, name: str, fetch: Callable[[], bytes]) -> bytes:
+        """Return a segment from the cache, fetching and storing it on a miss.
+
+        - master_url: The master playlist URL of the space.
+        - name: The file name of the segment.
+        - fetch: The function downloading the segment on a miss.
+
+        - return: The content of the segment.
+        """
+        path = self.path(self.key(master_url, name))
+        while (data := self._read(path)) is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            token = self._lock(path)
+            if token is None:
+                time.sleep(LOCK_POLL_INTERVAL)
+                continue
+            try:
+                if (data := self._read(path)) is not None:
+                    break
+                self.misses += 1
+                data = fetch()
+                self._store(path, data)
+            finally:
+                self._unlock(path, token)
+            self.evict()
+            return data
+        self.hits += 1
+        return data
+
+    def _store(self, path: str, data: bytes) -> None:
+        """Atomically write a segment so that readers never see partial files."""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_io:
+                temp_io.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def evict(self, force: bool = False) -> None:
+        """Remove the least recently used segments until the cache fits `max_size`.
+
+        - force: Evict even if the last eviction happened less than
+          `EVICT_INTERVAL` seconds ago.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_eviction < EVICT_INTERVAL:
+            return
+        self._last_eviction = now
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith((".lock", ".tmp")):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+        logging.debug("Segment cache evicted down to %d bytes", total)
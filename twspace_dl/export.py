@@ -0,0 +1,208 @@
+"""Export the metadata of many spaces without downloading them"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, TextIO
+
+import requests
+
+from .api import API, rate_limit_delay
+
+"""Default number of spaces resolved concurrently."""
+DEFAULT_WORKERS = 8
+
+"""Times the lookup of a space is retried when all the accounts are rate limited."""
+RATE_LIMIT_RETRIES = 3
+
+"""Fields of the rows written by the `rows` format, in order."""
+ROW_FIELDS = (
+    "id",
+    "title",
+    "state",
+    "media_key",
+    "created_at",
+    "scheduled_start",
+    "started_at",
+    "ended_at",
+    "updated_at",
+    "is_space_available_for_replay",
+    "total_live_listeners",
+    "total_replay_watched",
+    "creator_id",
+    "creator_name",
+    "creator_screen_name",
+    "creator_profile_image_url",
+)
+
+
+def space_id_from_input(value: str) -> str:
+    """Extract the space ID from a space URL, or return the value if it is an ID.
+
+    - value: A space URL like `https://x.com/i/spaces/<space_id>` or a space ID.
+
+    - return: The space ID.
+
+    - raise ValueError: If the value is neither a space URL nor a space ID.
+    """
+    value = value.strip()
+    if match := re.search(r"(?<=spaces/)\w+", value):
+        return match.group()
+    if re.fullmatch(r"\w+", value):
+        return value
+    raise ValueError(f"Not a space URL or ID: {value}")
+
+
+def iter_space_ids(path: str) -> Iterator[str]:
+    """Read space URLs or IDs from a file, one per line.
+
+    Empty lines and lines starting with `#` are ignored, invalid lines are logged and
+    skipped.
+
+    - path: The path of the file, `-` for the standard input.
+
+    - return: An iterator over the space IDs.
+    """
+    if path == "-":
+        batch_io = sys.stdin
+    else:
+        batch_io = open(path, encoding="utf-8")
+    with batch_io:
+        for line in batch_io:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                yield space_id_from_input(line)
+            except ValueError as err:
+                logging.error(err)
+
+
+def iter_metadata_files(*paths: str) -> Iterator[dict]:
+    """Load metadata json files (as written by `--write-metadata`).
+
+    - paths: Metadata files, or directories searched recursively for `.json` files.
+
+    - return: An iterator over the loaded metadata.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, file)
+                for root, _, files in os.walk(path)
+                for file in files
+                if file.endswith(".json")
+            )
+        else:
+            files = [path]
+        for file in files:
+            try:
+                with open(file, encoding="utf-8") as metadata_io:
+                    yield json.load(metadata_io)
+            except (OSError, ValueError) as err:
+                logging.error("Cannot load metadata from %s: %s", file, err)
+
+
+def _ordered_map(
+    function: Callable[[str], Any], items: Iterable[str], workers: int
+) -> Iterator[Any]:
+    """Like `ThreadPoolExecutor.map` but only keeps `2 * workers` items in flight."""
+    with ThreadPoolExecutor(workers) as executor:
+        pending: deque[Future] = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _fetch_metadata(space_id: str) -> dict | None:
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            metadata: dict = API.graphql_api.audio_space_by_id(space_id)
+            break
+        except requests.HTTPError as err:
+            delay = rate_limit_delay(err)
+            if delay is None or attempt == RATE_LIMIT_RETRIES:
+                logging.error("Cannot retrieve metadata of space %s: %s", space_id, err)
+                return None
+            logging.warning(
+                "Rate limited, retrying space %s in %d seconds", space_id, delay
+            )
+            time.sleep(delay)
+        except (RuntimeError, requests.RequestException) as err:
+            logging.error("Cannot retrieve metadata of space %s: %s", space_id, err)
+            return None
+    if not metadata.get("data", {}).get("audioSpace", {}).get("metadata"):
+        logging.error("No metadata for space %s", space_id)
+        return None
+    return metadata
+
+
+def iter_metadata(
+    space_ids: Iterable[str], workers: int = DEFAULT_WORKERS
+) -> Iterator[dict]:
+    """Retrieve the metadata of spaces with the `AudioSpaceById` API.
+
+    Spaces that can't be retrieved are logged and skipped.
+
+    - space_ids: The IDs of the spaces.
+    - workers: The number of spaces resolved concurrently.
+
+    - return: An iterator over the metadata, in the order of `space_ids`.
+    """
+    for metadata in _ordered_map(_fetch_metadata, space_ids, workers):
+        if metadata is not None:
+            yield metadata
+
+
+def metadata_row(metadata: dict) -> dict[str, Any]:
+    """Flatten the metadata of a space to a row with the fields of `ROW_FIELDS`.
+
+    Missing values are `None` so that all rows have the same schema.
+
+    - metadata: The metadata returned by the `AudioSpaceById` API.
+
+    - return: The flat row.
+    """
+    root = metadata["data"]["audioSpace"]["metadata"]
+    result = root.get("creator_results", {}).get("result", {})
+    creator = result.get("legacy", {})
+    row = {field: root.get(field) for field in ROW_FIELDS}
+    row["id"] = root.get("rest_id")
+    row["creator_id"] = result.get("rest_id")
+    row["creator_name"] = creator.get("name")
+    row["creator_screen_name"] = creator.get("screen_name")
+    if image_url := creator.get("profile_image_url_https"):
+        row["creator_profile_image_url"] = image_url.replace("_normal", "")
+    return row
+
+
+def export_metadata(
+    metadata: Iterable[dict], output: TextIO, export_format: str = "ndjson"
+) -> int:
+    """Write metadata as newline-delimited compact JSON.
+
+    - metadata: The metadata of the spaces.
+    - output: The text stream to write to.
+    - export_format: `ndjson` to write the full metadata, `rows` to write flat rows
+      with a fixed schema (see `metadata_row`).
+
+    - return: The number of spaces written.
+    """
+    count = 0
+    for item in metadata:
+        if export_format == "rows":
+            item = metadata_row(item)
+        output.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+        output.write("\n")
+        count += 1
+    return count
@@ -0,0 +1,432 @@
+"""Coordinate the recordings of several hosts with leased jobs"""
+
+from __future__ import annotations
+
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Iterator
+from urllib.parse import unquote, urlparse
+
+"""Seconds a lease lasts without being renewed, renewed every third of it."""
+LEASE_TTL = 30
+
+"""Part of the TTL kept as a safety margin: a lease not renewed for the rest of it is
+given up before it can expire and be claimed by another owner."""
+LEASE_SAFETY_MARGIN = 0.2
+
+"""Seconds the Redis backend remembers finished jobs and their journal."""
+DONE_TTL = 7 * 24 * 60 * 60
+
+"""Prefix of the keys used by the Redis backend."""
+REDIS_PREFIX = "twspace-dl"
+
+"""Lua script extending a lease in Redis only if it is still held by the owner."""
+REDIS_RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+"""
+
+"""Lua script releasing a lease in Redis only if it is still held by the owner."""
+REDIS_RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then return 0 end
+if ARGV[2] == "1" then redis.call("SET", KEYS[2], ARGV[1], "EX", ARGV[3]) end
+return redis.call("DEL", KEYS[1])
+"""
+
+
+class JobClaimedError(RuntimeError):
+    """Raised when a job is already finished or leased by another owner."""
+
+
+class Lease:
+    """A claimed job, kept alive by a heartbeat thread."""
+
+    def __init__(self, store: JobStore, space_id: str, owner: str, ttl: float) -> None:
+        """Initialize the lease and start its heartbeat.
+
+        - store: The job store the job was claimed from.
+        - space_id: The ID of the space of the job.
+        - owner: The owner of the lease.
+        - ttl: The duration of the lease in seconds.
+        """
+        self.store = store
+        self.space_id = space_id
+        self.owner = owner
+        self.ttl = ttl
+        # set when the lease couldn't be renewed and another owner may take over
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_forever, daemon=True)
+        self._heartbeat.start()
+
+    def _renew_forever(self) -> None:
+        renewed_at = time.monotonic()
+        deadline = self.ttl * (1 - LEASE_SAFETY_MARGIN)
+        while not self._stopped.wait(
+            min(self.ttl / 3, max(renewed_at + deadline - time.monotonic(), 0))
+        ):
+            try:
+                renewed = self.store.renew(self.space_id, self.owner, self.ttl)
+            except (OSError, RuntimeError, sqlite3.Error) as err:
+                logging.warning("Cannot renew the lease of %s: %s", self.space_id, err)
+                if time.monotonic() - renewed_at < deadline:
+                    # keep trying until the lease is about to expire
+                    continue
+                renewed = False
+            if not renewed:
+                logging.error("Lease of space %s was lost", self.space_id)
+                self.lost.set()
+                return
+            renewed_at = time.monotonic()
+
+    def save_journal(self, journal: dict[str, Any]) -> None:
+        """Save the progress of the recording for the owner taking over on failure."""
+        try:
+            self.store.save_journal(self.space_id, journal)
+        except (OSError, RuntimeError, sqlite3.Error) as err:
+            logging.warning("Cannot save the journal of %s: %s", self.space_id, err)
+
+    def stop(self) -> None:
+        """Stop the heartbeat."""
+        self._stopped.set()
+        self._heartbeat.join()
+
+
+class JobStore(ABC):
+    """Store of recording jobs shared by several hosts.
+
+    A job is identified by its space ID. A host claims a job before recording the
+    space and keeps its lease alive while recording; if the host dies, the lease
+    expires and another host can claim the job and read the journal left by the
+    previous owner.
+    """
+
+    @abstractmethod
+    def claim(self, space_id: str, owner: str, ttl: float) -> bool:
+        """Lease a job if it is free, expired or already leased by the same owner.
+
+        - return: `True` if the job was leased, `False` if it is finished or leased by
+          another owner.
+        """
+
+    @abstractmethod
+    def renew(self, space_id: str, owner: str, ttl: float) -> bool:
+        """Extend a lease.
+
+        - return: `False` if the lease was lost to another owner.
+        """
+
+    @abstractmethod
+    def release(self, space_id: str, owner: str, done: bool) -> None:
+        """Give up a lease, marking the job as finished if `done`."""
+
+    @abstractmethod
+    def owner(self, space_id: str) -> str | None:
+        """Return the current owner of a job, if any."""
+
+    @abstractmethod
+    def save_journal(self, space_id: str, journal: dict[str, Any]) -> None:
+        """Save the journal of a job."""
+
+    @abstractmethod
+    def load_journal(self, space_id: str) -> dict[str, Any] | None:
+        """Load the journal of a job, if any."""
+
+    @contextmanager
+    def lease(
+        self, space_id: str, owner: str, ttl: float = LEASE_TTL
+    ) -> Iterator[Lease]:
+        """Lease a job for the duration of the context.
+
+        The job is marked as finished if the context exits normally, otherwise it is
+        released for another owner to take over.
+
+        - raise JobClaimedError: If the job is finished or leased by another owner.
+        """
+        if not self.claim(space_id, owner, ttl):
+            raise JobClaimedError(
+                f"Space {space_id} is already recorded by {self.owner(space_id)}"
+            )
+        lease = Lease(self, space_id, owner, ttl)
+        try:
+            yield lease
+        except BaseException:
+            lease.stop()
+            self._release(space_id, owner, done=False)
+            raise
+        lease.stop()
+        self._release(space_id, owner, done=not lease.lost.is_set())
+
+    def _release(self, space_id: str, owner: str, done: bool) -> None:
+        # the recording is over, a failing store only delays the next owner
+        try:
+            self.release(space_id, owner, done)
+        except (OSError, RuntimeError, sqlite3.Error) as err:
+            logging.warning("Cannot release the lease of %s: %s", space_id, err)
+
+
+class SQLiteJobStore(JobStore):
+    """Job store in an SQLite database, for hosts sharing a filesystem or for tests."""
+
+    def __init__(self, path: str) -> None:
+        """Open the database, creating it if needed.
+
+        - path: The path of the database file.
+        """
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "space_id TEXT PRIMARY KEY, owner TEXT, expires_at REAL NOT NULL, "
+                "done INTEGER NOT NULL DEFAULT 0, journal TEXT)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # one connection per operation, the heartbeat runs in another thread
+        connection = sqlite3.connect(self.path, timeout=LEASE_TTL, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def claim(self, space_id: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT owner, expires_at, done FROM jobs WHERE space_id = ?",
+                (space_id,),
+            ).fetchone()
+            if row is not None:
+                current_owner, expires_at, done = row
+                if done or (current_owner not in (None, owner) and expires_at > now):
+                    return False
+            connection.execute(
+                "INSERT INTO jobs (space_id, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (space_id) DO UPDATE "
+                "SET owner = excluded.owner, expires_at = excluded.expires_at",
+                (space_id, owner, now + ttl),
+            )
+            return True
+
+    def renew(self, space_id: str, owner: str, ttl: float) -> bool:
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET expires_at = ? "
+                "WHERE space_id = ? AND owner = ? AND done = 0",
+                (time.time() + ttl, space_id, owner),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, space_id: str, owner: str, done: bool) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET owner = NULL, expires_at = 0, done = ? "
+                "WHERE space_id = ? AND owner = ?",
+                (int(done), space_id, owner),
+            )
+
+    def owner(self, space_id: str) -> str | None:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT owner FROM jobs WHERE space_id = ? AND expires_at > ?",
+                (space_id, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_journal(self, space_id: str, journal: dict[str, Any]) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET journal = ? WHERE space_id = ?",
+                (json.dumps(journal), space_id),
+            )
+
+    def load_journal(self, space_id: str) -> dict[str, Any] | None:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT journal FROM jobs WHERE space_id = ?", (space_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+
+class RESPClient:
+    """Minimal client of the Redis serialization protocol (RESP2)."""
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: str | None = None,
+        timeout: float = 10,
+    ) -> None:
+        """Initialize the client, the connection is opened on the first command.
+
+        - host: The host of the server.
+        - port: The port of the server.
+        - db: The index of the database to select.
+        - password: The password to authenticate with, if any.
+        - timeout: The socket timeout in seconds.
+        """
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket: socket.socket | None = None
+        self._reader: Any = None
+
+    def _connect(self) -> None:
+        self._socket = socket.create_connection(self.address, self.timeout)
+        self._reader = self._socket.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def close(self) -> None:
+        """Close the connection, the next command opens a new one."""
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, *args: Any) -> Any:
+        assert self._socket is not None
+        parts = [str(arg).encode("utf-8") for arg in args]
+        request = b"*%d\r\n" % len(parts) + b"".join(
+            b"$%d\r\n%s\r\n" % (len(part), part) for part in parts
+        )
+        self._socket.sendall(request)
+        return self._read_reply()
+
+    def _read_reply(self) -> Any:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {value.decode('utf-8')}")
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            if int(value) < 0:
+                return None
+            data = self._reader.read(int(value) + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            if int(value) < 0:
+                return None
+            return [self._read_reply() for _ in range(int(value))]
+        raise RuntimeError(f"Invalid Redis reply: {line!r}")
+
+    def command(self, *args: Any) -> Any:
+        """Send a command and return its reply, reconnecting once if needed."""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    return self._send(*args)
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+
+class RedisJobStore(JobStore):
+    """Job store in Redis, or any server speaking its protocol and running Lua scripts."""
+
+    def __init__(self, client: RESPClient, prefix: str = REDIS_PREFIX) -> None:
+        """Initialize the store.
+
+        - client: The client connected to the server.
+        - prefix: The prefix of all the keys used by the store.
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, kind: str, space_id: str) -> str:
+        return f"{self.prefix}:{kind}:{space_id}"
+
+    def claim(self, space_id: str, owner: str, ttl: float) -> bool:
+        if self.client.command("EXISTS", self._key("done", space_id)):
+            return False
+        key = self._key("lease", space_id)
+        ttl_ms = int(ttl * 1000)
+        if self.client.command("SET", key, owner, "NX", "PX", ttl_ms) == "OK":
+            return True
+        return self.renew(space_id, owner, ttl)
+
+    def renew(self, space_id: str, owner: str, ttl: float) -> bool:
+        # checked and extended in one script, the lease may expire in between
+        return bool(
+            self.client.command(
+                "EVAL",
+                REDIS_RENEW_SCRIPT,
+                1,
+                self._key("lease", space_id),
+                owner,
+                int(ttl * 1000),
+            )
+        )
+
+    def release(self, space_id: str, owner: str, done: bool) -> None:
+        self.client.command(
+            "EVAL",
+            REDIS_RELEASE_SCRIPT,
+            2,
+            self._key("lease", space_id),
+            self._key("done", space_id),
+            owner,
+            int(done),
+            DONE_TTL,
+        )
+
+    def owner(self, space_id: str) -> str | None:
+        return self.client.command("GET", self._key("lease", space_id))
+
+    def save_journal(self, space_id: str, journal: dict[str, Any]) -> None:
+        self.client.command(
+            "SET", self._key("journal", space_id), json.dumps(journal), "EX", DONE_TTL
+        )
+
+    def load_journal(self, space_id: str) -> dict[str, Any] | None:
+        journal = self.client.command("GET", self._key("journal", space_id))
+        return json.loads(journal) if journal else None
+
+
+def open_job_store(url: str) -> JobStore:
+    """Open the job store at the specified URL.
+
+    Supported URLs:
+    - sqlite:///path/to/jobs.db (or a plain path)
+    - redis://[:password@]host[:port][/db]
+
+    - raise ValueError: If the URL scheme is not supported.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "sqlite"):
+        return SQLiteJobStore(parsed.path if parsed.scheme else url)
+    if parsed.scheme == "redis":
+        client = RESPClient(
+            parsed.hostname or "localhost",
+            parsed.port or 6379,
+            int(parsed.path.strip("/") or 0),
+            unquote(parsed.password) if parsed.password else None,
+        )
+        return RedisJobStore(client)
+    raise ValueError(f"Unsupported job store: {url}")
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from typing import NamedTuple
+from urllib.parse import urljoin
+
+
+class Segment(NamedTuple):
+    """A media segment listed in an HLS media playlist."""
+
+    """Media sequence number of the segment."""
+    sequence: int
+    """Absolute URL of the segment."""
+    url: str
+    """Duration of the segment in seconds, as advertised by `#EXTINF`."""
+    duration: float
+
+    @property
+    def name(self) -> str:
+        """The file name of the segment, e.g. `chunk_1690000000000_0_a.aac`."""
+        return self.url.rsplit("/", 1)[-1].split("?", 1)[0]
+
+
+class MediaPlaylist(NamedTuple):
+    """The parsed content of an HLS media playlist."""
+
+    segments: list[Segment]
+    target_duration: float
+    """Whether the playlist has `#EXT-X-ENDLIST`, i.e. no segment will be added."""
+    ended: bool
+
+
+class MediaPlaylistParser:
+    """Parser of the successive versions of a live media playlist.
+
+    When a new version only appends lines to the previous one, only the new tail is
+    parsed, and an unchanged playlist is not parsed at all.
+    """
+
+    def __init__(self, base_url: str = "") -> None:
+        """Initialize the parser.
+
+        - base_url: The URL that relative segment URIs are resolved against.
+        """
+        self.base_url = base_url
+        self._reset()
+
+    def _reset(self) -> None:
+        self._text = ""
+        self._playlist = MediaPlaylist([], 0.0, False)
+        self._segments: list[Segment] = []
+        self._sequence = 0
+        self._target_duration = 0.0
+        self._duration = 0.0
+        self._ended = False
+
+    def parse(self, text: str) -> MediaPlaylist:
+        """Parse a version of the playlist.
+
+        - text: The content of the media playlist.
+
+        - return: The parsed media playlist.
+        """
+        if text == self._text:
+            return self._playlist
+        if self._text.endswith("\n") and text.startswith(self._text):
+            tail = text[len(self._text) :]
+        else:
+            self._reset()
+            tail = text
+        for line in tail.splitlines():
+            self._parse_line(line.strip())
+        self._text = text
+        self._playlist = MediaPlaylist(
+            list(self._segments), self._target_duration, self._ended
+        )
+        return self._playlist
+
+    def _parse_line(self, line: str) -> None:
+        if not line:
+            return
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            self._sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            self._target_duration = float(line.split(":", 1)[1])
+        elif line.startswith("#EXTINF:"):
+            self._duration = float(line.split(":", 1)[1].split(",", 1)[0])
+        elif line.startswith("#EXT-X-ENDLIST"):
+            self._ended = True
+        elif not line.startswith("#"):
+            url = urljoin(self.base_url, line)
+            self._segments.append(Segment(self._sequence, url, self._duration))
+            self._sequence += 1
+            self._duration = 0.0
+
+
+def parse_media_playlist(text: str, base_url: str = "") -> MediaPlaylist:
+    """Parse the segments of an HLS media playlist.
+
+    - text: The content of the media playlist.
+    - base_url: The URL that relative segment URIs are resolved against.
+
+    - return: The parsed media playlist.
+    """
+    return MediaPlaylistParser(base_url).parse(text)
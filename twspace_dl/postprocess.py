@@ -0,0 +1,393 @@
+"""Post-process finished recordings in a pool of worker processes"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from types import TracebackType
+from typing import Any, Callable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+from mutagen.mp4 import MP4, MP4Cover
+
+from .api import API
+
+MP4_COVER_FORMAT_MAP = {"jpg": MP4Cover.FORMAT_JPEG, "png": MP4Cover.FORMAT_PNG}
+
+"""Integrated loudness targeted by the `loudnorm` step in LUFS, as recommended by EBU R128."""
+LOUDNESS_TARGET = -23.0
+
+"""Maximum true peak of the `loudnorm` step in dBTP."""
+LOUDNESS_TRUE_PEAK = -1.0
+
+"""Loudness range targeted by the `loudnorm` step in LU."""
+LOUDNESS_RANGE = 7.0
+
+"""Seconds between two attempts to take a post-processing slot of the host."""
+SLOT_POLL_INTERVAL = 1
+
+"""Extension, muxer, codec, bitrate and sample rate of the transcoding steps."""
+ENCODINGS = {
+    "opus": ("opus", "opus", "libopus", "48k", "48000"),
+    "mp3": ("mp3", "mp3", "libmp3lame", "96k", "44100"),
+}
+
+
+def download_cover(url: str) -> tuple[bytes, int] | None:
+    """Download a profile image and return it with its MP4 cover format.
+
+    - return: The image and its format, `None` if the format is not supported.
+
+    - raise RuntimeError: If the image cannot be downloaded.
+    """
+    cover_ext = url.split(".")[-1]
+    if not (cover_format := MP4_COVER_FORMAT_MAP.get(cover_ext)):
+        logging.error(f"Unsupported user profile image format: {cover_ext}")
+        return None
+    try:
+        response = API.client.get(url)
+    except RuntimeError:
+        logging.error(f"Cannot download user profile image from URL: {url}")
+        raise
+    return response.content, cover_format
+
+
+class PostProcessJob:
+    """A finished recording going through the steps of a `PostProcessor`."""
+
+    def __init__(self, path: str, space: dict[str, Any]) -> None:
+        """Initialize the job.
+
+        - path: The path of the `.m4a` file.
+        - space: The metadata of the space, see `Twspace`.
+        """
+        self.path = path
+        self.space = space
+        # ffmpeg filter applied by the transcoding steps, set by the `loudnorm` step
+        self.audio_filter: str | None = None
+        # files written by the steps
+        self.outputs: list[str] = []
+
+
+def _ffmpeg(*args: str) -> str:
+    """Run ffmpeg on a single thread, the parallelism comes from the pool.
+
+    - return: The standard error output of ffmpeg.
+
+    - raise RuntimeError: If ffmpeg fails.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-nostats", "-threads", "1", *args]
+    logging.debug("Post-processing command: %s", " ".join(cmd))
+    process = subprocess.run(cmd, capture_output=True, text=True, errors="replace")
+    if process.returncode:
+        raise RuntimeError(f"ffmpeg failed: {process.stderr.strip()[-500:]}")
+    return process.stderr
+
+
+def embed_cover(job: PostProcessJob) -> None:
+    """Embed the profile image of the creator of the space as the cover art."""
+    if cover := download_cover(job.space["creator_profile_image_url"]):
+        content, cover_format = cover
+        meta = MP4(job.path)
+        if meta.tags is None:
+            meta.add_tags()
+        meta.tags["covr"] = [MP4Cover(content, imageformat=cover_format)]
+        meta.save()
+
+
+def measure_loudness(job: PostProcessJob) -> None:
+    """Measure the loudness of the recording for the following transcoding steps.
+
+    This is the first pass of the `loudnorm` filter of ffmpeg, the transcoding steps
+    do the second one with the measured values, for a linear normalization.
+    """
+    target = f"I={LOUDNESS_TARGET}:TP={LOUDNESS_TRUE_PEAK}:LRA={LOUDNESS_RANGE}"
+    output = _ffmpeg(
+        "-i",
+        job.path,
+        "-vn",
+        "-af",
+        f"loudnorm={target}:print_format=json",
+        "-f",
+        "null",
+        "-",
+    )
+    # the measures are the last json object printed, followed by the stats
+    if not (objects := re.findall(r"\{[^{}]*\}", output)):
+        raise RuntimeError("Cannot read the loudness measured by ffmpeg")
+    measured = json.loads(objects[-1])
+    job.audio_filter = (
+        f"loudnorm={target}:measured_I={measured['input_i']}"
+        f":measured_TP={measured['input_tp']}:measured_LRA={measured['input_lra']}"
+        f":measured_thresh={measured['input_thresh']}"
+        f":offset={measured['target_offset']}:linear=true"
+    )
+
+
+def _transcoder(encoding: str) -> Callable[[PostProcessJob], None]:
+    extension, muxer, codec, bitrate, sample_rate = ENCODINGS[encoding]
+
+    def transcode(job: PostProcessJob) -> None:
+        """Encode the recording next to it, normalized if measured by `loudnorm`."""
+        output = os.path.splitext(job.path)[0] + f".{extension}"
+        filters = ["-af", job.audio_filter] if job.audio_filter else []
+        _ffmpeg(
+            "-y",
+            "-i",
+            job.path,
+            "-vn",
+            *filters,
+            "-map_metadata",
+            "0",
+            "-c:a",
+            codec,
+            "-b:a",
+            bitrate,
+            "-ar",
+            sample_rate,
+            "-f",
+            muxer,
+            output + ".part",
+        )
+        os.replace(output + ".part", output)
+        job.outputs.append(output)
+
+    return transcode
+
+
+"""Steps available to a `PostProcessor`, in the order given by the user."""
+POSTPROCESS_STEPS: dict[str, Callable[[PostProcessJob], None]] = {
+    "cover": embed_cover,
+    "loudnorm": measure_loudness,
+    "opus": _transcoder("opus"),
+    "mp3": _transcoder("mp3"),
+}
+
+
+def parse_steps(steps: str) -> list[str]:
+    """Parse a comma-separated chain of post-processing steps, e.g. `cover,loudnorm,opus`.
+
+    - raise ValueError: If a step is unknown, or `loudnorm` is not followed by a
+      transcoding step.
+    """
+    chain = [step.strip() for step in steps.split(",") if step.strip()]
+    if unknown := [step for step in chain if step not in POSTPROCESS_STEPS]:
+        raise ValueError(f"Unknown post-processing steps: {', '.join(unknown)}")
+    if "loudnorm" in chain and not (
+        ENCODINGS.keys() & chain[chain.index("loudnorm") :]
+    ):
+        raise ValueError("loudnorm must be followed by a transcoding step")
+    return chain
+
+
+@contextmanager
+def host_slot(slots: int, directory: str | None = None) -> Iterator[None]:
+    """Wait for one of the post-processing slots shared by all the processes of the host.
+
+    The slots are lock files, released by the system even if the process dies.
+    Without file locks (Windows), the jobs are not limited.
+
+    - slots: The number of jobs running at once on the host.
+    - directory: The directory of the lock files, defaults to the temporary one.
+    """
+    if fcntl is None:
+        yield
+        return
+    directory = directory or tempfile.gettempdir()
+    while True:
+        for index in range(slots):
+            path = os.path.join(directory, f"twspace-dl-postprocess-{index}.lock")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def run_steps(
+    steps: list[str], job: PostProcessJob, slots: int | None = None
+) -> list[str]:
+    """Apply a chain of steps to a recording, in a worker process.
+
+    - slots: The number of jobs running at once on the host, see `host_slot()`,
+      `None` to not wait for a slot.
+
+    - return: The paths of the files written by the steps.
+    """
+    if slots is None:
+        for step in steps:
+            POSTPROCESS_STEPS[step](job)
+        return job.outputs
+    with host_slot(slots):
+        return run_steps(steps, job)
+
+
+def _init_worker() -> None:
+    # Ctrl+C is handled by the main process, which waits for the running jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PostProcessor:
+    """Pool of worker processes applying a chain of steps to finished recordings.
+
+    Recordings are queued with `submit()`, which returns immediately so that the
+    recording process never waits on encoding. The jobs run in parallel on at most
+    one process per CPU, each ffmpeg being limited to one thread, and wait for a slot
+    shared with the other pools of the host.
+
+    ```python
+    with PostProcessor(["cover", "loudnorm", "opus"]) as postprocessor:
+        TwspaceDL(twspace, "", postprocessor=postprocessor).download()
+    ```
+
+    Leaving the `with` block waits for the queued jobs.
+    """
+
+    def __init__(self, steps: list[str], workers: int | None = None) -> None:
+        """Initialize the pool, the processes are started with the first job.
+
+        - steps: The names of the steps, see `POSTPROCESS_STEPS` and `parse_steps`.
+        - workers: The maximum number of processes, defaults to the number of CPUs.
+
+        - raise FileNotFoundError: If a step needs ffmpeg and it is not installed.
+        """
+        if {"loudnorm", *ENCODINGS} & set(steps) and not shutil.which("ffmpeg"):
+            raise FileNotFoundError("ffmpeg not installed")
+        self.steps = steps
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+
+    def __enter__(self) -> PostProcessor:
+        return self
+
+    def __exit__(
+        self,
+        _: type[BaseException] | None,
+        _e: BaseException | None,
+        _t: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def submit(self, path: str, space: dict[str, Any]) -> Future:
+        """Queue a finished recording.
+
+        - path: The path of the `.m4a` file.
+        - space: The metadata of the space, see `Twspace`.
+
+        - return: The future of the paths of the files written by the steps.
+        """
+        future = self._executor.submit(
+            run_steps, self.steps, PostProcessJob(path, dict(space)), self.workers
+        )
+        future.add_done_callback(lambda future: self._done(path, future))
+        return future
+
+    def _done(self, path: str, future: Future) -> None:
+        if future.cancelled():
+            return
+        if err := future.exception():
+            logging.error("Post-processing of %s failed: %s", path, err)
+        else:
+            logging.info("Finished post-processing %s", path)
+
+    def close(self) -> None:
+        """Wait for the queued jobs and stop the processes."""
+        self._executor.shutdown()
+
+
+class DetachedPostProcessor:
+    """Post-processing of finished recordings in processes outliving the recorder.
+
+    Each recording is handed to a new process in its own session, so that a recorder
+    of a single space exits right after its download, e.g. for `monitor.sh` to catch
+    the next space. The processes of all the recorders of the host wait for one of
+    `workers` slots, see `host_slot()`.
+    """
+
+    def __init__(self, steps: list[str], workers: int | None = None) -> None:
+        """Initialize the post-processor.
+
+        - steps: The names of the steps, see `POSTPROCESS_STEPS` and `parse_steps`.
+        - workers: The number of jobs running at once on the host, defaults to the
+          number of CPUs.
+
+        - raise FileNotFoundError: If a step needs ffmpeg and it is not installed.
+        """
+        if {"loudnorm", *ENCODINGS} & set(steps) and not shutil.which("ffmpeg"):
+            raise FileNotFoundError("ffmpeg not installed")
+        self.steps = steps
+        self.workers = workers or os.cpu_count() or 1
+
+    def __enter__(self) -> DetachedPostProcessor:
+        return self
+
+    def __exit__(
+        self,
+        _: type[BaseException] | None,
+        _e: BaseException | None,
+        _t: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def submit(self, path: str, space: dict[str, Any]) -> subprocess.Popen:
+        """Start the post-processing of a finished recording, without waiting for it.
+
+        - path: The path of the `.m4a` file.
+        - space: The metadata of the space, see `Twspace`.
+
+        - return: The process, left running when the recorder exits.
+        """
+        # not -m, the package imports this module before running it
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys, twspace_dl.postprocess as p; sys.exit(p.main())",
+        ]
+        cmd += ["--steps", ",".join(self.steps), "--workers", str(self.workers)]
+        cmd += ["--space", json.dumps(dict(space)), path]
+        logging.info("Post-processing %s in the background", path)
+        return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, start_new_session=True)
+
+    def close(self) -> None:
+        """Nothing to wait for, the processes outlive the recorder."""
+
+
+def main() -> int:
+    """Post-process a recording, run by `DetachedPostProcessor`"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--steps", type=parse_steps, required=True)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--space", type=json.loads, default={})
+    parser.add_argument("path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    try:
+        run_steps(args.steps, PostProcessJob(args.path, args.space), args.workers)
+    except Exception as err:
+        logging.error("Post-processing of %s failed: %s", args.path, err)
+        return 1
+    logging.info("Finished post-processing %s", args.path)
+    return 0
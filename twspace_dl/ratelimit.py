@@ -0,0 +1,152 @@
+"""Limit the bandwidth and the number of concurrent requests"""
+
+from __future__ import annotations
+
+import os
+import re
+import struct
+import threading
+import time
+from types import TracebackType
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+"""Multipliers of the suffixes accepted by `parse_rate`."""
+RATE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(rate: str) -> int:
+    """Parse a rate like `500K` or `2M` (bytes per second, binary multiples).
+
+    - rate: The rate to parse.
+
+    - return: The rate in bytes per second.
+
+    - raise ValueError: If the rate is not valid.
+    """
+    if not (match := re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?)B?", rate.strip().upper())):
+        raise ValueError(f"Invalid rate: {rate}")
+    return int(float(match.group(1)) * RATE_SUFFIXES[match.group(2)])
+
+
+class RateLimiter:
+    """Token bucket limiting bytes per second, and semaphore limiting in-flight requests.
+
+    The limiter is thread-safe and can be shared by any number of clients.
+    Use it as a context manager around a request to count it as in flight, and call
+    `consume()` as bytes are received.
+    """
+
+    def __init__(
+        self, bytes_per_second: int | None = None, max_in_flight: int | None = None
+    ) -> None:
+        """Initialize the limiter.
+
+        - bytes_per_second: The maximum average rate, `None` for unlimited.
+        - max_in_flight: The maximum number of concurrent requests, `None` for
+          unlimited.
+        """
+        self.bytes_per_second = bytes_per_second
+        self.max_in_flight = max_in_flight
+        self._semaphore = (
+            threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        )
+        self._lock = threading.Lock()
+        # allow bursts of up to one second worth of data
+        self._tokens = float(bytes_per_second or 0)
+        self._updated = time.monotonic()
+
+    def __enter__(self) -> RateLimiter:
+        if self._semaphore:
+            self._semaphore.acquire()
+        return self
+
+    def __exit__(
+        self,
+        _: type[BaseException] | None,
+        _e: BaseException | None,
+        _t: TracebackType | None,
+    ) -> None:
+        if self._semaphore:
+            self._semaphore.release()
+
+    def consume(self, size: int) -> None:
+        """Account for received bytes, sleeping as long as needed to respect the rate.
+
+        - size: The number of bytes received.
+        """
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.bytes_per_second),
+                self._tokens + (now - self._updated) * self.bytes_per_second,
+            )
+            self._updated = now
+            # the bucket can go into debt, later callers wait for it to be repaid
+            self._tokens -= size
+            delay = -self._tokens / self.bytes_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+    """Token bucket shared by all the processes using the same state file.
+
+    The bucket is stored in the file and updated under an exclusive lock, so that
+    recorders running as separate processes, e.g. one service per space, share the
+    bandwidth budget of the host. The limit of in-flight requests is per process.
+    """
+
+    def __init__(
+        self, path: str, bytes_per_second: int, max_in_flight: int | None = None
+    ) -> None:
+        """Initialize the limiter.
+
+        - path: The path of the state file, created if missing.
+        - bytes_per_second: The maximum average rate of all the processes.
+        - max_in_flight: The maximum number of concurrent requests of this process,
+          `None` for unlimited.
+
+        - raise OSError: If file locks are not supported by the platform.
+        """
+        if fcntl is None:
+            raise OSError("Shared rate limits are not supported on this platform")
+        super().__init__(bytes_per_second, max_in_flight)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def consume(self, size: int) -> None:
+        if not self.bytes_per_second:
+            return
+        # the file lock excludes the other processes, the thread lock this one's
+        # threads, which share the open file
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = os.pread(self._fd, 16, 0)
+                # wall clock, the monotonic clocks of processes are not comparable
+                now = time.time()
+                if len(state) == 16:
+                    tokens, updated = struct.unpack("<dd", state)
+                    tokens = min(
+                        float(self.bytes_per_second),
+                        tokens + max(now - updated, 0) * self.bytes_per_second,
+                    )
+                else:
+                    tokens = float(self.bytes_per_second)
+                tokens -= size
+                os.pwrite(self._fd, struct.pack("<dd", tokens, now), 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            delay = -tokens / self.bytes_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self) -> None:
+        """Close the state file."""
+        os.close(self._fd)
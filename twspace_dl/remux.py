@@ -0,0 +1,865 @@
+"""Remux ADTS AAC streams into MP4 (m4a) files without ffmpeg"""
+
+from __future__ import annotations
+
+import shutil
+import struct
+import tempfile
+from typing import Collection, Iterator, NamedTuple, Protocol, Sequence
+
+"""Sampling frequencies indexed by the ADTS `sampling_frequency_index` field."""
+SAMPLE_RATES = (
+    96000,
+    88200,
+    64000,
+    48000,
+    44100,
+    32000,
+    24000,
+    22050,
+    16000,
+    12000,
+    11025,
+    8000,
+    7350,
+)
+
+"""Number of PCM samples decoded from a single AAC frame."""
+SAMPLES_PER_FRAME = 1024
+
+"""Timescale of the movie header, durations in `mvhd` and `tkhd` are in milliseconds."""
+MOVIE_TIMESCALE = 1000
+
+"""iTunes metadata atoms of the supported tags (same mapping as ffmpeg's)."""
+ITUNES_ATOMS = {
+    "title": b"\xa9nam",
+    "artist": b"\xa9ART",
+    "album": b"\xa9alb",
+    "date": b"\xa9day",
+    "comment": b"\xa9cmt",
+    "episode_id": b"tven",
+}
+
+"""Data types of the `covr` atom, same values as `mutagen.mp4.MP4Cover` formats."""
+COVER_FORMAT_JPEG = 13
+COVER_FORMAT_PNG = 14
+
+"""Unity transformation matrix used by `mvhd` and `tkhd`."""
+UNITY_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+class RemuxError(ValueError):
+    """Raised when the input can't be remuxed by the built-in remuxer."""
+
+
+class AudioConfig(NamedTuple):
+    """Stream parameters shared by all the frames of an AAC stream."""
+
+    object_type: int
+    sampling_index: int
+    channel_config: int
+
+    @property
+    def sample_rate(self) -> int:
+        """Sampling frequency of the stream in Hz."""
+        return SAMPLE_RATES[self.sampling_index]
+
+    @property
+    def channels(self) -> int:
+        """Number of audio channels of the stream."""
+        return 8 if self.channel_config == 7 else self.channel_config or 2
+
+    @property
+    def audio_specific_config(self) -> bytes:
+        """The MPEG-4 `AudioSpecificConfig` of the stream."""
+        value = (
+            self.object_type << 11 | self.sampling_index << 7 | self.channel_config << 3
+        )
+        return value.to_bytes(2, "big")
+
+
+class BinaryFile(Protocol):
+    """Binary file written by the MP4 writers, a regular file or e.g. an upload.
+
+    The writers which aren't `seekable` only call `write` and `flush`, unless resumed.
+    """
+
+    def write(self, data: bytes, /) -> int: ...
+
+    def flush(self) -> None: ...
+
+    def read(self, size: int = -1, /) -> bytes: ...
+
+    def seek(self, offset: int, whence: int = 0, /) -> int: ...
+
+    def truncate(self, size: int | None = None, /) -> int: ...
+
+
+class ADTSFrame(NamedTuple):
+    """A single AAC frame stripped from its ADTS header."""
+
+    config: AudioConfig
+    payload: bytes
+
+
+def skip_id3(data: bytes, offset: int = 0) -> int:
+    """Skip the ID3v2 tag starting at the specified offset, if any.
+
+    Twitter Spaces segments start with an ID3 tag carrying the segment timestamp.
+
+    - data: The content of the segment.
+    - offset: The offset to look for the tag at.
+
+    - return: The offset of the first byte after the tag.
+    """
+    while data[offset : offset + 3] == b"ID3" and len(data) >= offset + 10:
+        flags = data[offset + 5]
+        size = 0
+        for byte in data[offset + 6 : offset + 10]:
+            size = size << 7 | byte & 0x7F
+        offset += 10 + size + (10 if flags & 0x10 else 0)
+    return offset
+
+
+def parse_adts(data: bytes) -> list[ADTSFrame]:
+    """Split an ADTS stream into AAC frames.
+
+    - data: The ADTS stream, optionally prefixed with ID3 tags.
+
+    - return: The AAC frames of the stream.
+
+    - raise RemuxError: If the stream is not a valid ADTS stream.
+    """
+    frames = []
+    offset = skip_id3(data)
+    end = len(data)
+    while offset < end:
+        if data[offset : offset + 3] == b"ID3":
+            offset = skip_id3(data, offset)
+            continue
+        header = data[offset : offset + 7]
+        if len(header) < 7 or header[0] != 0xFF or header[1] & 0xF6 != 0xF0:
+            raise RemuxError(f"Invalid ADTS sync word at offset {offset}")
+        frame_length = (header[3] & 0x03) << 11 | header[4] << 3 | header[5] >> 5
+        header_length = 7 if header[1] & 0x01 else 9
+        if header[6] & 0x03:
+            raise RemuxError(
+                "ADTS frames with multiple raw data blocks are unsupported"
+            )
+        if frame_length <= header_length or offset + frame_length > end:
+            raise RemuxError(f"Truncated ADTS frame at offset {offset}")
+        config = AudioConfig(
+            object_type=(header[2] >> 6) + 1,
+            sampling_index=(header[2] >> 2) & 0x0F,
+            channel_config=(header[2] & 0x01) << 2 | header[3] >> 6,
+        )
+        if config.sampling_index >= len(SAMPLE_RATES):
+            raise RemuxError(
+                f"Invalid ADTS sampling frequency index at offset {offset}"
+            )
+        frames.append(
+            ADTSFrame(config, data[offset + header_length : offset + frame_length])
+        )
+        offset += frame_length
+    return frames
+
+
+def iter_boxes(
+    data: bytes, containers: Collection[bytes] = ()
+) -> Iterator[tuple[bytes, bytes]]:
+    """Iterate over the boxes of an in-memory box payload, descending in containers."""
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header:
+            return
+        payload = data[offset + header : offset + size]
+        if kind in containers:
+            yield from iter_boxes(payload, containers)
+        else:
+            yield kind, payload
+        offset += size
+
+
+def iter_file_boxes(
+    fileobj: BinaryFile, start: int, end: int
+) -> Iterator[tuple[bytes, int, int, bool]]:
+    """Iterate over the boxes between two offsets of a file.
+
+    - return: An iterator over the type, payload offset, payload end and whether the
+      box is cut by `end`, of each box.
+    """
+    offset = start
+    while offset + 8 <= end:
+        fileobj.seek(offset)
+        size, kind = struct.unpack(">I4s", fileobj.read(8))
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", fileobj.read(8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            yield kind, offset + header, end, True
+            return
+        yield kind, offset + header, min(offset + size, end), offset + size > end
+        offset += size
+
+
+def _box(kind: bytes, *payloads: bytes) -> bytes:
+    """Build an ISO BMFF box."""
+    payload = b"".join(payloads)
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def _full_box(kind: bytes, version: int, flags: int, *payloads: bytes) -> bytes:
+    """Build an ISO BMFF full box, i.e. a box with version and flags."""
+    return _box(kind, struct.pack(">I", version << 24 | flags), *payloads)
+
+
+def _descriptor(tag: int, *payloads: bytes) -> bytes:
+    """Build an MPEG-4 descriptor with a 4 bytes expandable size field."""
+    payload = b"".join(payloads)
+    size = len(payload)
+    size_field = bytes(
+        [
+            0x80 | (size >> 21) & 0x7F,
+            0x80 | (size >> 14) & 0x7F,
+            0x80 | (size >> 7) & 0x7F,
+            size & 0x7F,
+        ]
+    )
+    return bytes([tag]) + size_field + payload
+
+
+def _iter_descriptors(data: bytes) -> Iterator[tuple[int, bytes]]:
+    """Iterate over the tag and payload of the MPEG-4 descriptors of a buffer."""
+    offset = 0
+    while offset < len(data):
+        tag = data[offset]
+        size = 0
+        offset += 1
+        while offset < len(data):
+            byte = data[offset]
+            offset += 1
+            size = size << 7 | byte & 0x7F
+            if not byte & 0x80:
+                break
+        yield tag, data[offset : offset + size]
+        offset += size
+
+
+def _read_audio_config(stsd: bytes) -> AudioConfig:
+    """Read the stream parameters from the payload of an `stsd` box.
+
+    - raise RemuxError: If the sample description is not AAC.
+    """
+    for entry_kind, entry in iter_boxes(stsd[8:]):
+        if entry_kind != b"mp4a":
+            continue
+        for kind, esds in iter_boxes(entry[28:]):
+            if kind != b"esds":
+                continue
+            for tag, es_descriptor in _iter_descriptors(esds[4:]):
+                # optional fields of the ES descriptor are never used for audio
+                if tag != 0x03 or es_descriptor[2] & 0xE0:
+                    continue
+                for tag, decoder_config in _iter_descriptors(es_descriptor[3:]):
+                    if tag != 0x04:
+                        continue
+                    for tag, info in _iter_descriptors(decoder_config[13:]):
+                        if tag == 0x05 and len(info) >= 2:
+                            return AudioConfig(
+                                object_type=info[0] >> 3,
+                                sampling_index=(info[0] & 0x07) << 1 | info[1] >> 7,
+                                channel_config=info[1] >> 3 & 0x0F,
+                            )
+    raise RemuxError("No AAC sample description")
+
+
+class MP4Writer:
+    """Streaming writer of AAC audio to an MP4 (m4a) file.
+
+    The frames are written to the `mdat` box as they arrive and only the sample tables
+    are kept in memory, the `moov` box is written at the end by `close()`.
+    Each call to `write_frames()` (usually one HLS segment) is stored as one MP4 chunk.
+    """
+
+    """Whether the file is playable while it is being written."""
+    streamable = False
+
+    """Whether `fileobj` must be seekable."""
+    seekable = True
+
+    def __init__(
+        self,
+        fileobj: BinaryFile,
+        tags: dict[str, str] | None = None,
+        cover: tuple[bytes, int] | None = None,
+    ) -> None:
+        """Initialize the writer.
+
+        - fileobj: The seekable binary file to write to, positioned at its start.
+        - tags: The metadata to write, keys are the ones of `ITUNES_ATOMS`.
+        - cover: The cover art to embed and its format (`COVER_FORMAT_JPEG` or
+          `COVER_FORMAT_PNG`).
+        """
+        self.fileobj = fileobj
+        self.tags = {key: value for key, value in (tags or {}).items() if value}
+        self.cover = cover
+        self.config: AudioConfig | None = None
+        self.sample_sizes: list[int] = []
+        self.chunk_offsets: list[int] = []
+        self.chunk_samples: list[int] = []
+        # (media time, duration) in samples of the edit list, see `trim()`
+        self.edit: tuple[int, int | None] | None = None
+        self._mdat_start = 0
+        self._position = 0
+        self._data_size = 0
+        # file offset of the audio data, final once the file is closed
+        self._data_offset = 0
+
+    @property
+    def sample_count(self) -> int:
+        """Number of AAC frames written so far."""
+        return len(self.sample_sizes)
+
+    @property
+    def duration(self) -> float:
+        """Duration of the audio written so far in seconds."""
+        if self.config is None:
+            return 0.0
+        return self.sample_count * SAMPLES_PER_FRAME / self.config.sample_rate
+
+    def trim(self, start: int, duration: int | None = None) -> None:
+        """Only present part of the written audio, with an edit list.
+
+        Trimming is sample-accurate without re-encoding, and the frames before `start`
+        still serve as decoder pre-roll.
+        Fragmented files write the edit list with the first frames, so the writer must
+        be trimmed before the first call to `write_frames()`.
+
+        - start: The first sample to present, counted from the first written frame.
+        - duration: The number of samples to present, `None` for all the remaining.
+        """
+        self.edit = (start, duration)
+
+    @property
+    def presentation_duration(self) -> int:
+        """Duration of the presentation in samples, after applying the edit list."""
+        media_duration = self.sample_count * SAMPLES_PER_FRAME
+        if self.edit is None:
+            return media_duration
+        start, duration = self.edit
+        if not self.sample_count:
+            # fragmented files write "moov" before any sample, 0 means unknown
+            return duration or 0
+        available = max(media_duration - start, 0)
+        return available if duration is None else min(duration, available)
+
+    def _write(self, data: bytes) -> None:
+        self.fileobj.write(data)
+        self._position += len(data)
+
+    def _start(self) -> None:
+        """Write the file header and the header of `mdat` with a placeholder size."""
+        self._write(self._ftyp())
+        self._mdat_start = self._position
+        # 64-bit "largesize" mdat header, patched with the actual size in close()
+        self._write(struct.pack(">I4sQ", 1, b"mdat", 0))
+
+    def write_frames(self, frames: Sequence[ADTSFrame]) -> None:
+        """Append AAC frames to the file as a single chunk.
+
+        - frames: The frames to append.
+
+        - raise RemuxError: If the stream parameters changed midway.
+        """
+        if not frames:
+            return
+        if self.config is None:
+            self.config = frames[0].config
+            self._start()
+        if any(frame.config != self.config for frame in frames):
+            raise RemuxError("AAC stream parameters changed midway")
+        self._append(frames)
+
+    def _append(self, frames: Sequence[ADTSFrame]) -> None:
+        """Write the frames as a chunk of `mdat` and record them in the sample tables."""
+        payload = b"".join(frame.payload for frame in frames)
+        self.chunk_offsets.append(self._data_size)
+        self.chunk_samples.append(len(frames))
+        self.sample_sizes.extend(len(frame.payload) for frame in frames)
+        self._write(payload)
+        self._data_size += len(payload)
+
+    def write_segment(self, data: bytes) -> int:
+        """Append the content of an ADTS segment to the file.
+
+        - data: The content of the segment.
+
+        - return: Number of AAC frames appended.
+        """
+        frames = parse_adts(data)
+        self.write_frames(frames)
+        return len(frames)
+
+    def resume(self) -> None:
+        """Continue a file written with the same layout and finalized by `close()`.
+
+        `fileobj` must be the existing file opened for reading and writing, the next
+        frames are appended to its audio data and `close()` finalizes it again.
+
+        - raise RemuxError: If the file can't be continued.
+        """
+        mdat = self._load_file()
+        start, stop = mdat
+        self.fileobj.seek(start - 16)
+        if self.fileobj.read(8) != struct.pack(">I4s", 1, b"mdat"):
+            raise RemuxError("The file wasn't written by the built-in remuxer")
+        self._mdat_start = start - 16
+        self._data_size = stop - start
+        self._position = stop
+        # drop "moov", it is written again by close()
+        self.fileobj.seek(stop)
+        self.fileobj.truncate()
+
+    def _load_file(self) -> tuple[int, int]:
+        """Load the stream parameters and the sample tables of the file.
+
+        - return: The offsets of the start and the end of the audio data.
+
+        - raise RemuxError: If the file is not a complete MP4 file.
+        """
+        end = self.fileobj.seek(0, 2)
+        moov = mdat = None
+        for kind, start, stop, cut in iter_file_boxes(self.fileobj, 0, end):
+            if cut:
+                raise RemuxError("The file is truncated")
+            if kind == b"moov":
+                self.fileobj.seek(start)
+                moov = self.fileobj.read(stop - start)
+            elif kind == b"mdat":
+                mdat = (start, stop)
+        if moov is None or mdat is None:
+            raise RemuxError("The file wasn't finalized")
+        self._load_moov(moov, mdat[0])
+        return mdat
+
+    def _load_moov(self, moov: bytes, data_offset: int) -> None:
+        """Load the stream parameters and the sample tables from `moov`.
+
+        - data_offset: Absolute file offset of the first byte of the audio data.
+        """
+        boxes = dict(iter_boxes(moov, {b"trak", b"mdia", b"minf", b"stbl"}))
+        if not {b"stsd", b"stsz", b"stsc"} <= boxes.keys():
+            raise RemuxError("No sample tables")
+        self.config = _read_audio_config(boxes[b"stsd"])
+        sample_size, count = struct.unpack_from(">II", boxes[b"stsz"], 4)
+        if sample_size:
+            self.sample_sizes = [sample_size] * count
+        else:
+            self.sample_sizes = list(
+                struct.unpack_from(f">{count}I", boxes[b"stsz"], 12)
+            )
+        if b"co64" in boxes:
+            (chunks,) = struct.unpack_from(">I", boxes[b"co64"], 4)
+            offsets = struct.unpack_from(f">{chunks}Q", boxes[b"co64"], 8)
+        else:
+            (chunks,) = struct.unpack_from(">I", boxes[b"stco"], 4)
+            offsets = struct.unpack_from(f">{chunks}I", boxes[b"stco"], 8)
+        self.chunk_offsets = [offset - data_offset for offset in offsets]
+        (entries,) = struct.unpack_from(">I", boxes[b"stsc"], 4)
+        runs = [
+            struct.unpack_from(">II", boxes[b"stsc"], 8 + index * 12)
+            for index in range(entries)
+        ]
+        self.chunk_samples = []
+        for index, (first, samples) in enumerate(runs):
+            last = runs[index + 1][0] if index + 1 < len(runs) else chunks + 1
+            self.chunk_samples.extend([samples] * (last - first))
+        if sum(self.chunk_samples) != count:
+            raise RemuxError("Inconsistent sample tables")
+
+    def close(self) -> None:
+        """Finalize the file by patching the size of `mdat` and writing `moov`.
+
+        - raise RemuxError: If no frame was written.
+        """
+        if self.config is None:
+            raise RemuxError("No audio frames to write")
+        end = self._position
+        self.fileobj.seek(self._mdat_start + 8)
+        self.fileobj.write(struct.pack(">Q", end - self._mdat_start))
+        self.fileobj.seek(end)
+        self._data_offset = self._mdat_start + 16
+        self._write(self._moov(self._data_offset))
+        self.fileobj.flush()
+
+    def chunk_positions(self) -> list[int]:
+        """Return the file offsets of the chunks, one per call to `write_frames()`.
+
+        The offsets are final once the file is closed.
+        """
+        return [self._data_offset + offset for offset in self.chunk_offsets]
+
+    def _ftyp(self) -> bytes:
+        return _box(b"ftyp", b"M4A ", struct.pack(">I", 0x200), b"M4A isomiso2mp41")
+
+    def _moov(self, data_offset: int) -> bytes:
+        """Build the `moov` box.
+
+        - data_offset: Absolute file offset of the first byte of the audio data.
+        """
+        assert self.config is not None
+        duration = (
+            self.presentation_duration * MOVIE_TIMESCALE // self.config.sample_rate
+        )
+        mvhd = _full_box(
+            b"mvhd",
+            0,
+            0,
+            struct.pack(">IIII", 0, 0, MOVIE_TIMESCALE, duration),
+            struct.pack(">IH10x", 0x00010000, 0x0100),
+            UNITY_MATRIX,
+            bytes(24),
+            struct.pack(">I", 2),
+        )
+        return _box(b"moov", mvhd, self._trak(duration, data_offset), self._udta())
+
+    def _trak(self, duration: int, data_offset: int) -> bytes:
+        assert self.config is not None
+        tkhd = _full_box(
+            b"tkhd",
+            0,
+            0x000003,  # track enabled and in movie
+            struct.pack(">IIIII", 0, 0, 1, 0, duration),
+            struct.pack(">8xhhH2x", 0, 0, 0x0100),
+            UNITY_MATRIX,
+            struct.pack(">II", 0, 0),
+        )
+        mdhd = _full_box(
+            b"mdhd",
+            0,
+            0,
+            struct.pack(
+                ">IIIIHH",
+                0,
+                0,
+                self.config.sample_rate,
+                self.sample_count * SAMPLES_PER_FRAME,
+                0x55C4,  # "und"
+                0,
+            ),
+        )
+        hdlr = _full_box(
+            b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"soun"), b"SoundHandler\0"
+        )
+        smhd = _full_box(b"smhd", 0, 0, struct.pack(">hH", 0, 0))
+        dinf = _box(
+            b"dinf",
+            _full_box(b"dref", 0, 0, struct.pack(">I", 1), _full_box(b"url ", 0, 1)),
+        )
+        minf = _box(b"minf", smhd, dinf, self._stbl(data_offset))
+        mdia = _box(b"mdia", mdhd, hdlr, minf)
+        if self.edit is None:
+            return _box(b"trak", tkhd, mdia)
+        # segment duration in movie timescale, media time in samples, rate 1.0
+        elst = _full_box(
+            b"elst", 0, 0, struct.pack(">IIiHH", 1, duration, self.edit[0], 1, 0)
+        )
+        return _box(b"trak", tkhd, _box(b"edts", elst), mdia)
+
+    def _stsd(self) -> bytes:
+        assert self.config is not None
+        # fragmented files write the sample description before any sample is known
+        max_size = max(self.sample_sizes, default=0)
+        max_bitrate = max_size * 8 * self.config.sample_rate // SAMPLES_PER_FRAME
+        avg_bitrate = 0
+        if self.sample_sizes:
+            avg_bitrate = int(sum(self.sample_sizes) * 8 / self.duration)
+        decoder_config = _descriptor(
+            0x04,
+            bytes([0x40, 0x15]),  # MPEG-4 audio, audio stream
+            max_size.to_bytes(3, "big"),
+            struct.pack(">II", max_bitrate, avg_bitrate),
+            _descriptor(0x05, self.config.audio_specific_config),
+        )
+        es_descriptor = _descriptor(
+            0x03, struct.pack(">HB", 1, 0), decoder_config, _descriptor(0x06, b"\x02")
+        )
+        mp4a = _box(
+            b"mp4a",
+            struct.pack(">6xH8x", 1),
+            struct.pack(">HHHH", self.config.channels, 16, 0, 0),
+            struct.pack(">I", (self.config.sample_rate << 16) & 0xFFFFFFFF),
+            _full_box(b"esds", 0, 0, es_descriptor),
+        )
+        return _full_box(b"stsd", 0, 0, struct.pack(">I", 1), mp4a)
+
+    def _stbl(self, data_offset: int) -> bytes:
+        stts = _full_box(
+            b"stts", 0, 0, struct.pack(">III", 1, self.sample_count, SAMPLES_PER_FRAME)
+        )
+        stsc_entries: list[tuple[int, int]] = []
+        for index, samples in enumerate(self.chunk_samples):
+            if not stsc_entries or stsc_entries[-1][1] != samples:
+                stsc_entries.append((index + 1, samples))
+        stsc = _full_box(
+            b"stsc",
+            0,
+            0,
+            struct.pack(">I", len(stsc_entries)),
+            b"".join(
+                struct.pack(">III", first, count, 1) for first, count in stsc_entries
+            ),
+        )
+        stsz = _full_box(
+            b"stsz",
+            0,
+            0,
+            struct.pack(">II", 0, self.sample_count),
+            struct.pack(f">{self.sample_count}I", *self.sample_sizes),
+        )
+        offsets = [data_offset + offset for offset in self.chunk_offsets]
+        if offsets and offsets[-1] > 0xFFFFFFFF:
+            stco = _full_box(
+                b"co64",
+                0,
+                0,
+                struct.pack(f">I{len(offsets)}Q", len(offsets), *offsets),
+            )
+        else:
+            stco = _full_box(
+                b"stco",
+                0,
+                0,
+                struct.pack(f">I{len(offsets)}I", len(offsets), *offsets),
+            )
+        return _box(b"stbl", self._stsd(), stts, stsc, stsz, stco)
+
+    def _udta(self) -> bytes:
+        items = [
+            _box(
+                ITUNES_ATOMS[key],
+                _box(b"data", struct.pack(">II", 1, 0), value.encode("utf-8")),
+            )
+            for key, value in self.tags.items()
+            if key in ITUNES_ATOMS
+        ]
+        if self.cover:
+            data, cover_format = self.cover
+            items.append(
+                _box(b"covr", _box(b"data", struct.pack(">II", cover_format, 0), data))
+            )
+        hdlr = _full_box(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"mdir"), b"\0")
+        meta = _full_box(b"meta", 0, 0, hdlr, _box(b"ilst", *items))
+        return _box(b"udta", meta)
+
+
+class FastStartMP4Writer(MP4Writer):
+    """Writer of MP4 files with `moov` before `mdat`, playable before fully downloaded.
+
+    The audio data is spooled to a temporary file until `close()`, which then writes
+    the whole file in a single pass, so `fileobj` doesn't need to be seekable.
+    """
+
+    seekable = False
+
+    def __init__(
+        self,
+        fileobj: BinaryFile,
+        tags: dict[str, str] | None = None,
+        cover: tuple[bytes, int] | None = None,
+    ) -> None:
+        super().__init__(fileobj, tags, cover)
+        self._spool = tempfile.TemporaryFile()
+        self._resumed = False
+
+    def _start(self) -> None:
+        pass
+
+    def resume(self) -> None:
+        """Continue a file written with the same layout.
+
+        The audio data of the file is spooled again, `close()` then rewrites the whole
+        file in place.
+
+        - raise RemuxError: If the file can't be continued.
+        """
+        start, stop = self._load_file()
+        self.fileobj.seek(start)
+        remaining = stop - start
+        while remaining:
+            chunk = self.fileobj.read(min(remaining, 1024**2))
+            if not chunk:
+                raise RemuxError("The file is truncated")
+            self._spool.write(chunk)
+            remaining -= len(chunk)
+        self._data_size = stop - start
+        self._resumed = True
+        self.fileobj.seek(0)
+
+    def _write(self, data: bytes) -> None:
+        self._spool.write(data)
+
+    def close(self) -> None:
+        """Write the file header, `moov` and the spooled audio data.
+
+        - raise RemuxError: If no frame was written.
+        """
+        if self.config is None:
+            self._spool.close()
+            raise RemuxError("No audio frames to write")
+        ftyp = self._ftyp()
+        moov = b""
+        # the offsets in "stco" depend on the size of "moov", which depends on
+        # whether the offsets fit in 32 bits
+        while True:
+            new_moov = self._moov(len(ftyp) + len(moov) + 16)
+            done = len(new_moov) == len(moov)
+            moov = new_moov
+            if done:
+                break
+        self._data_offset = len(ftyp) + len(moov) + 16
+        self.fileobj.write(ftyp)
+        self.fileobj.write(moov)
+        self.fileobj.write(struct.pack(">I4sQ", 1, b"mdat", 16 + self._data_size))
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, self.fileobj)
+        self._spool.close()
+        if self._resumed:
+            self.fileobj.truncate()
+        self.fileobj.flush()
+
+
+class FragmentedMP4Writer(MP4Writer):
+    """Writer of fragmented MP4 files, playable while they are being written.
+
+    `moov` only describes the stream, each call to `write_frames()` is written as a
+    `moof` + `mdat` fragment and nothing is kept in memory, so `fileobj` doesn't need
+    to be seekable.
+    """
+
+    streamable = True
+    seekable = False
+
+    def __init__(
+        self,
+        fileobj: BinaryFile,
+        tags: dict[str, str] | None = None,
+        cover: tuple[bytes, int] | None = None,
+    ) -> None:
+        super().__init__(fileobj, tags, cover)
+        self._fragments = 0
+        self._samples = 0
+        self._fragment_offsets: list[int] = []
+
+    @property
+    def sample_count(self) -> int:
+        return self._samples
+
+    def _ftyp(self) -> bytes:
+        return _box(b"ftyp", b"iso6", struct.pack(">I", 0x200), b"iso6isommp41M4A ")
+
+    def _start(self) -> None:
+        self._write(self._ftyp())
+        moov = self._moov(0)
+        trex = _full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0))
+        # insert "mvex" as the last child of "moov"
+        self._write(_box(b"moov", moov[8:], _box(b"mvex", trex)))
+        self.fileobj.flush()
+
+    def resume(self) -> None:
+        """Continue a file written with the same layout.
+
+        Fragmented files don't need to be finalized: a fragment cut by an interruption
+        is dropped and the next frames are appended after the last complete one.
+
+        - raise RemuxError: If the file can't be continued.
+        """
+        end = self.fileobj.seek(0, 2)
+        valid_end = 0
+        pending = None
+        for kind, start, stop, cut in iter_file_boxes(self.fileobj, 0, end):
+            if cut:
+                break
+            if kind in (b"moov", b"moof"):
+                self.fileobj.seek(start)
+                payload = self.fileobj.read(stop - start)
+            if kind == b"moov":
+                boxes = dict(iter_boxes(payload, {b"trak", b"mdia", b"minf", b"stbl"}))
+                if b"stsd" not in boxes:
+                    raise RemuxError("No sample description")
+                self.config = _read_audio_config(boxes[b"stsd"])
+                valid_end = stop
+            elif kind == b"moof":
+                pending_offset = start - 8
+                pending = sum(
+                    struct.unpack_from(">I", trun, 4)[0]
+                    for trun_kind, trun in iter_boxes(payload, {b"traf"})
+                    if trun_kind == b"trun"
+                )
+            elif kind == b"mdat" and pending is not None:
+                self._fragments += 1
+                self._samples += pending
+                self._fragment_offsets.append(pending_offset)
+                pending = None
+                valid_end = stop
+        if self.config is None:
+            raise RemuxError("The file has no header")
+        self.fileobj.seek(valid_end)
+        self.fileobj.truncate()
+        self._position = valid_end
+
+    def chunk_positions(self) -> list[int]:
+        """Return the file offsets of the fragments, one per call to `write_frames()`."""
+        return list(self._fragment_offsets)
+
+    def _append(self, frames: Sequence[ADTSFrame]) -> None:
+        self._fragment_offsets.append(self._position)
+        self._fragments += 1
+        sizes = [len(frame.payload) for frame in frames]
+        mfhd = _full_box(b"mfhd", 0, 0, struct.pack(">I", self._fragments))
+        # default-base-is-moof, default-sample-duration-present
+        tfhd = _full_box(b"tfhd", 0, 0x020008, struct.pack(">II", 1, SAMPLES_PER_FRAME))
+        tfdt = _full_box(
+            b"tfdt", 1, 0, struct.pack(">Q", self._samples * SAMPLES_PER_FRAME)
+        )
+        trun_size = 8 + 12 + 4 * len(sizes)
+        moof_size = 8 + len(mfhd) + 8 + len(tfhd) + len(tfdt) + trun_size
+        # data-offset-present, sample-size-present
+        trun = _full_box(
+            b"trun",
+            0,
+            0x000201,
+            struct.pack(">Ii", len(sizes), moof_size + 8),
+            struct.pack(f">{len(sizes)}I", *sizes),
+        )
+        self._write(_box(b"moof", mfhd, _box(b"traf", tfhd, tfdt, trun)))
+        self._write(_box(b"mdat", *(frame.payload for frame in frames)))
+        self.fileobj.flush()
+        self._samples += len(frames)
+
+    def close(self) -> None:
+        """Flush the file, fragments are complete as soon as they are written.
+
+        - raise RemuxError: If no frame was written.
+        """
+        if self.config is None:
+            raise RemuxError("No audio frames to write")
+        self.fileobj.flush()
+
+
+"""Writers of the supported MP4 layouts."""
+MP4_WRITERS: dict[str, type[MP4Writer]] = {
+    "default": MP4Writer,
+    "faststart": FastStartMP4Writer,
+    "fragmented": FragmentedMP4Writer,
+}
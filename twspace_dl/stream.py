@@ -0,0 +1,157 @@
+"""Async iteration over the audio segments of a space, for use as a library"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent import futures
+from types import TracebackType
+from typing import NamedTuple
+
+from .twspace_dl import TwspaceDL
+
+"""Default number of segments fetched ahead of the consumer."""
+DEFAULT_BUFFER_SIZE = 4
+
+"""Seconds between checks that the stream is still open while the buffer is full."""
+PUT_CHECK_INTERVAL = 1
+
+# marks the end of the stream in the queue
+_END = object()
+
+
+class AudioSegment(NamedTuple):
+    """An audio segment of a space, as downloaded (ADTS AAC, see `remux.parse_adts`)."""
+
+    """Media sequence number of the segment."""
+    sequence: int
+    """Content of the segment."""
+    data: bytes
+    """Seconds from the start of the space to the start of the segment."""
+    start: float
+    """Duration of the segment in seconds, as advertised by the playlist."""
+    duration: float
+
+    @property
+    def end(self) -> float:
+        """Seconds from the start of the space to the end of the segment."""
+        return self.start + self.duration
+
+
+class SegmentStream:
+    """Async iterator over the audio segments of a space, replayed or live.
+
+    The segments are downloaded by a background thread, at most `buffer_size` ahead
+    of the consumer: when the consumer is slower, the thread waits and the playlist
+    isn't polled. The time range of the downloader (`start` and `end`) selects the
+    segments overlapping it. Nothing is written to disk.
+
+    ```python
+    twspace = Twspace.from_space_url(url)
+    async with SegmentStream(TwspaceDL(twspace, "")) as segments:
+        async for segment in segments:
+            transcribe(segment.data)
+    ```
+
+    Leaving the `async with` block, or calling `aclose()`, stops the download.
+    """
+
+    def __init__(
+        self, twspace_dl: TwspaceDL, buffer_size: int = DEFAULT_BUFFER_SIZE
+    ) -> None:
+        """Initialize the stream, the download starts with the iteration.
+
+        - twspace_dl: The downloader of the space.
+        - buffer_size: The maximum number of segments downloaded ahead.
+        """
+        self.twspace_dl = twspace_dl
+        self.buffer_size = buffer_size
+        self._queue: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._closed = threading.Event()
+
+    def __aiter__(self) -> SegmentStream:
+        return self
+
+    async def __aenter__(self) -> SegmentStream:
+        return self
+
+    async def __aexit__(
+        self,
+        _: type[BaseException] | None,
+        _e: BaseException | None,
+        _t: TracebackType | None,
+    ) -> None:
+        await self.aclose()
+
+    async def __anext__(self) -> AudioSegment:
+        if self._closed.is_set():
+            raise StopAsyncIteration
+        if self._queue is None:
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue(self.buffer_size)
+            self._thread = threading.Thread(target=self._produce, daemon=True)
+            self._thread.start()
+        item = await self._queue.get()
+        if item is _END:
+            self._closed.set()
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            self._closed.set()
+            raise item
+        return item
+
+    async def aclose(self) -> None:
+        """Stop the download and discard the segments downloaded ahead."""
+        self._closed.set()
+        self.twspace_dl.stop_event.set()
+        if self._queue is not None:
+            # unblock the thread if it is waiting for room in the queue
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    def _produce(self) -> None:
+        """Download the segments and queue them, in the background thread."""
+        twspace_dl = self.twspace_dl
+        start = 0.0
+        try:
+            for segment in twspace_dl.iter_segments():
+                if twspace_dl.end is not None and start >= twspace_dl.end:
+                    break
+                segment_start = start
+                start += segment.duration
+                if start <= twspace_dl.start:
+                    continue
+                data = twspace_dl.fetch_segment(segment)
+                audio_segment = AudioSegment(
+                    segment.sequence, data, segment_start, segment.duration
+                )
+                if not self._put(audio_segment):
+                    return
+        except Exception as err:
+            self._put(err)
+        else:
+            self._put(_END)
+
+    def _put(self, item: object) -> bool:
+        """Wait for room in the queue and add an item.
+
+        - return: `False` if the stream was closed.
+        """
+        assert self._loop is not None and self._queue is not None
+        if self._closed.is_set():
+            return False
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop)
+        except RuntimeError:
+            # the event loop was closed without closing the stream
+            return False
+        while True:
+            try:
+                future.result(PUT_CHECK_INTERVAL)
+                return not self._closed.is_set()
+            except futures.TimeoutError:
+                if self._closed.is_set() or self._loop.is_closed():
+                    future.cancel()
+                    return False
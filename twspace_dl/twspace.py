@@ -4,10 +4,37 @@ import json
 import logging
 import os
 import re
+import time
 from collections import defaultdict
 from datetime import datetime
 
-from .api import API
+import requests
+
+from .api import API, rate_limit_delay
+
+# Start polling a scheduled space that many seconds before its scheduled start
+PREWARM_LEAD_TIME = 60
+# Interval between two polls of a scheduled space about to start
+PREWARM_POLL_INTERVAL = 2
+# Seconds after its scheduled start a space not started yet is still polled that often
+LATE_START_WINDOW = 300
+# Interval between two polls of a space later than that, to spare the API quota
+LATE_POLL_INTERVAL = 30
+# Maximum sleep before checking a scheduled space again, in case it was rescheduled
+SCHEDULE_RECHECK_INTERVAL = 600
+# States of spaces that will never start
+FINAL_STATES = ("Ended", "Canceled", "TimedOut")
+
+
+class SpaceNotStartedError(ValueError):
+    """Raised when a space is scheduled but not started yet"""
+
+    def __init__(self, scheduled_start: datetime) -> None:
+        super().__init__(
+            "Space should start at "
+            f"{scheduled_start.strftime('%Y-%m-%d %H:%M:%S')}, try again later"
+        )
+        self.scheduled_start = scheduled_start
 
 
 class Twspace(dict):
@@ -36,9 +63,11 @@ class Twspace(dict):
                 self["creator_name"] = creator_info["name"]  # type: ignore
                 self["creator_screen_name"] = creator_info["screen_name"]  # type: ignore
                 self["creator_profile_image_url"] = creator_info["profile_image_url_https"].replace("_normal", "")  # type: ignore
-                self["creator_id"] = API.graphql_api.user_id(
-                    creator_info["screen_name"]
-                )
+                # the user ID is in the metadata, the API is only a fallback
+                creator_result = root["creator_results"]["result"]  # type: ignore
+                self["creator_id"] = creator_result.get(
+                    "rest_id"
+                ) or API.graphql_api.user_id(creator_info["screen_name"])
 
             self.source = metadata
             self.root = root
@@ -52,10 +81,8 @@ class Twspace(dict):
             except ValueError as err:
                 sched_start = datetime.fromtimestamp(
                     int(root["scheduled_start"]) / 1000
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                raise ValueError(
-                    f"Space should start at {sched_start}, try again later"
-                ) from err
+                )
+                raise SpaceNotStartedError(sched_start) from err
             self["state"] = root["state"]
             self["available_for_replay"] = root["is_space_available_for_replay"]
             self["media_key"] = root["media_key"]
@@ -138,11 +165,10 @@ class Twspace(dict):
         basename = self.sterilize_fn(actual_format_str % self)
         return os.path.join(abs_dir, basename)
 
-    @classmethod
-    def from_space_url(cls, url: str):
-        """Create a Twspace instance from a space url"""
+    @staticmethod
+    def _space_id(url: str) -> str:
         try:
-            space_id = re.findall(r"(?<=spaces/)\w*", url)[0]
+            return re.findall(r"(?<=spaces/)\w*", url)[0]
         except IndexError as err:
             raise ValueError(
                 (
@@ -150,7 +176,62 @@ class Twspace(dict):
                     "The URL format should 'https://x.com/i/spaces/<space_id>'"
                 )
             ) from err
-        return cls(cls._metadata(space_id))
+
+    @classmethod
+    def from_space_url(cls, url: str):
+        """Create a Twspace instance from a space url"""
+        return cls(cls._metadata(cls._space_id(url)))
+
+    @classmethod
+    def from_scheduled_space_url(
+        cls,
+        url: str,
+        lead_time: float = PREWARM_LEAD_TIME,
+        poll_interval: float = PREWARM_POLL_INTERVAL,
+    ):
+        """Create a Twspace instance from a space url, waiting for it to start
+
+        Sleep until `lead_time` seconds before the scheduled start, then poll the
+        space every `poll_interval` seconds so that it is caught as soon as it starts.
+        Spaces starting more than `LATE_START_WINDOW` seconds late are polled every
+        `LATE_POLL_INTERVAL` seconds.
+        """
+        space_id = cls._space_id(url)
+        while True:
+            try:
+                metadata: dict = API.graphql_api.audio_space_by_id(space_id)
+            except requests.HTTPError as error:
+                if (delay := rate_limit_delay(error)) is None:
+                    raise
+                logging.warning("Rate limited, waiting %d seconds", delay)
+                time.sleep(delay)
+                continue
+            try:
+                root = metadata["data"]["audioSpace"]["metadata"]
+            except KeyError as error:
+                logging.error(metadata)
+                raise ValueError("Space not found") from error
+            if root.get("started_at"):
+                return cls(metadata)
+            if root.get("state") in FINAL_STATES:
+                raise ValueError(f"Space won't start, its state is {root['state']}")
+            if not root.get("scheduled_start"):
+                raise ValueError("Space isn't started nor scheduled")
+            wait = int(root["scheduled_start"]) / 1000 - lead_time - time.time()
+            if wait > 0:
+                logging.info(
+                    "Space is scheduled at %s, waiting",
+                    datetime.fromtimestamp(int(root["scheduled_start"]) / 1000),
+                )
+                time.sleep(min(wait, SCHEDULE_RECHECK_INTERVAL))
+            else:
+                logging.debug("Space isn't started yet, polling")
+                late = time.time() - int(root["scheduled_start"]) / 1000
+                time.sleep(
+                    poll_interval
+                    if late < LATE_START_WINDOW
+                    else max(poll_interval, LATE_POLL_INTERVAL)
+                )
 
     @classmethod
     def from_user_avatar(cls, user_url: str):
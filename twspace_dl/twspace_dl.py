@@ -1,27 +1,89 @@
+from __future__ import annotations
+
+import json
 import logging
 import os
 import re
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
+import time
+from contextlib import ExitStack
 from functools import cached_property
+from typing import Any, Callable, Iterator
 from urllib.parse import urlparse
 
+import requests
 from mutagen.mp4 import MP4, MP4Cover
 
 from .api import API
+from .cache import SegmentCache
+from .playlist import MediaPlaylist, MediaPlaylistParser, Segment
+from .postprocess import DetachedPostProcessor, PostProcessor, download_cover
+from .ratelimit import RateLimiter
+from .remux import (
+    MP4_WRITERS,
+    SAMPLES_PER_FRAME,
+    ADTSFrame,
+    BinaryFile,
+    MP4Writer,
+    RemuxError,
+    parse_adts,
+)
 from .twspace import Twspace
+from .upload import S3Output
+from .waveform import DEFAULT_PEAK_INTERVAL, WaveformWriter
 
 DEFAULT_FNAME_FORMAT = "(%(creator_name)s)%(title)s-%(id)s"
-MP4_COVER_FORMAT_MAP = {"jpg": MP4Cover.FORMAT_JPEG, "png": MP4Cover.FORMAT_PNG}
+# Stop polling a live space when no new segment appeared for that many seconds
+LIVE_IDLE_TIMEOUT = 60
+# Polling interval used when the playlist doesn't advertise a target duration
+DEFAULT_POLL_INTERVAL = 3
+# Seconds ffmpeg is given to finalize its output when interrupted
+FFMPEG_FINALIZE_TIMEOUT = 10
 
 
 class TwspaceDL:
     """Downloader class for twitter spaces"""
 
-    def __init__(self, space: Twspace, format_str: str) -> None:
+    def __init__(
+        self,
+        space: Twspace,
+        format_str: str,
+        use_ffmpeg: bool = False,
+        layout: str = "default",
+        cache: SegmentCache | None = None,
+        limiter: RateLimiter | None = None,
+        start: float = 0.0,
+        end: float | None = None,
+        upload: S3Output | None = None,
+        postprocessor: PostProcessor | DetachedPostProcessor | None = None,
+        waveform: int | None = None,
+    ) -> None:
         self.space = space
         self.format_str = format_str or DEFAULT_FNAME_FORMAT
+        self.use_ffmpeg = use_ffmpeg
+        self.layout = layout
+        self.cache = cache
+        self.limiter = limiter
+        self.start = start
+        self.end = end
+        self.upload = upload
+        self.postprocessor = postprocessor
+        # milliseconds per peak of the waveform sidecar, None to not write it
+        self.waveform = waveform
+        # set to stop recording after the segment being written
+        self.stop_event = threading.Event()
+        # called with `journal` after each segment is written
+        self.journal_hook: Callable[[dict[str, Any]], None] | None = None
+        self._last_sequence = -1
+        self._last_segment = ""
+        # whether the local journal is updated after each segment
+        self._journal_in_place = False
+        self._playlist_parser: MediaPlaylistParser | None = None
+        self._waveform: WaveformWriter | None = None
         self._tempdir = ""
 
     @cached_property
@@ -61,7 +123,7 @@ class TwspaceDL:
     @property
     def playlist_url(self) -> str:
         """Get the URL containing the chunks filenames"""
-        response = API.client.get(self.master_url)
+        response = API.client.get(self.master_url, cache=True)
         playlist_suffix = response.text.splitlines()[3]
         domain = urlparse(self.master_url).netloc
         playlist_url = f"https://{domain}{playlist_suffix}"
@@ -75,6 +137,190 @@ class TwspaceDL:
         playlist_text = re.sub(r"(?=chunk)", master_url_wo_file, playlist_text)
         return playlist_text
 
+    @property
+    def media_playlist(self) -> MediaPlaylist:
+        """Fetch and parse the playlist containing the chunks"""
+        return self._fetch_media_playlist(self.playlist_url)
+
+    def _fetch_media_playlist(self, playlist_url: str) -> MediaPlaylist:
+        # unchanged playlists are served from memory and not parsed again
+        response = API.client.get(playlist_url, cache=True)
+        # skip the charset detection of requests, playlists are always UTF-8
+        response.encoding = "utf-8"
+        parser = self._playlist_parser
+        if parser is None or parser.base_url != self.master_url:
+            parser = self._playlist_parser = MediaPlaylistParser(self.master_url)
+        return parser.parse(response.text)
+
+    @property
+    def tags(self) -> dict[str, str]:
+        """Metadata written to the output file"""
+        return {
+            "title": self.space["title"],
+            "artist": self.space["creator_name"],
+            "episode_id": self.space["id"],
+        }
+
+    @property
+    def journal(self) -> dict[str, Any]:
+        """Progress of the recording, enough for another process to take over"""
+        return {
+            "space_id": self.space["id"],
+            "master_url": self.master_url,
+            "last_sequence": self._last_sequence,
+            "last_segment": self._last_segment,
+            "layout": self.layout,
+        }
+
+    @property
+    def journal_path(self) -> str:
+        """Path of the journal left next to an interrupted recording"""
+        return self.filename + ".m4a.journal"
+
+    @property
+    def waveform_path(self) -> str:
+        """Path of the waveform peaks and seek index of the recording"""
+        return self.filename + ".peaks.json"
+
+    def _segment_written(self, segment: Segment) -> None:
+        self._last_sequence = segment.sequence
+        self._last_segment = segment.name
+        if self._journal_in_place:
+            self._save_journal()
+        if self.journal_hook is not None:
+            self.journal_hook(self.journal)
+
+    def _save_journal(self) -> None:
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as journal_io:
+            json.dump(self.journal, journal_io)
+        os.replace(temp_path, self.journal_path)
+
+    def _prepare_resume(self, filename: str) -> bool:
+        """Continue an interrupted recording if its journal is found
+
+        The recording is copied to `filename` if it isn't written in place.
+        """
+        output = self.filename + ".m4a"
+        if not (os.path.exists(self.journal_path) and os.path.exists(output)):
+            return False
+        with open(self.journal_path, encoding="utf-8") as journal_io:
+            journal = json.load(journal_io)
+        if journal["space_id"] != self.space["id"] or journal["layout"] != self.layout:
+            logging.warning(
+                "%s is for another space or MP4 layout, starting over",
+                self.journal_path,
+            )
+            return False
+        # the master url may not be retrievable anymore, the space may have ended
+        self.__dict__.setdefault("master_url", journal["master_url"])
+        self._last_sequence = journal["last_sequence"]
+        self._last_segment = journal["last_segment"]
+        if filename != output:
+            shutil.copyfile(output, filename)
+        return True
+
+    def _save_partial(self, filename: str) -> None:
+        """Keep an interrupted recording, finalized by `_remux`, and its journal"""
+        if self._last_sequence < 0:
+            return
+        if filename != self.filename + ".m4a":
+            shutil.move(filename, self.filename + ".m4a")
+        if self.start > 0 or self.end is not None:
+            logging.info("Saved the partial recording to %s.m4a", self.filename)
+            return
+        self._save_journal()
+        logging.info(
+            "Saved the partial recording to %s.m4a, run again to download the rest",
+            self.filename,
+        )
+
+    def iter_segments(self) -> Iterator[Segment]:
+        """Yield the segments of the space in order
+
+        For a running space, the playlist is polled until the space ends.
+        Stops early when `stop_event` is set.
+        """
+        playlist_url = self.playlist_url
+        live = self.space["state"] == "Running"
+        # when resuming, continue after the last segment written
+        last_sequence = self._last_sequence
+        resume_segment = self._last_segment
+        last_update = time.monotonic()
+        while True:
+            try:
+                playlist = self._fetch_media_playlist(playlist_url)
+            except RuntimeError:
+                if not live or last_sequence < 0:
+                    raise
+                if self._has_ended():
+                    logging.info(
+                        "Playlist isn't available anymore, the space has ended"
+                    )
+                    return
+                # a transient failure, the recording isn't finalized as complete
+                if time.monotonic() - last_update > LIVE_IDLE_TIMEOUT:
+                    raise
+                logging.warning("Playlist isn't available, the space is still running")
+                if self.stop_event.wait(DEFAULT_POLL_INTERVAL):
+                    logging.info("Recording stopped")
+                    return
+                continue
+            if resume_segment:
+                # sequence numbers may differ between the live and replay playlists
+                for segment in playlist.segments:
+                    if segment.name == resume_segment:
+                        last_sequence = segment.sequence
+                resume_segment = ""
+            new_segments = [
+                segment
+                for segment in playlist.segments
+                if segment.sequence > last_sequence
+            ]
+            if new_segments:
+                last_sequence = new_segments[-1].sequence
+                last_update = time.monotonic()
+            for segment in new_segments:
+                if self.stop_event.is_set():
+                    logging.info("Recording stopped")
+                    return
+                yield segment
+            if not live or playlist.ended:
+                return
+            if time.monotonic() - last_update > LIVE_IDLE_TIMEOUT:
+                logging.info(
+                    "No new segment for %d seconds, stopping", LIVE_IDLE_TIMEOUT
+                )
+                return
+            if self.stop_event.wait(playlist.target_duration or DEFAULT_POLL_INTERVAL):
+                logging.info("Recording stopped")
+                return
+
+    def _has_ended(self) -> bool:
+        """Check with the API whether the space is over, not running anymore
+
+        Spaces without metadata can't be checked and are considered over.
+        """
+        if not self.space["id"]:
+            return True
+        try:
+            metadata: dict = API.graphql_api.audio_space_by_id(self.space["id"])
+            state = metadata["data"]["audioSpace"]["metadata"]["state"]
+        except (RuntimeError, KeyError, requests.RequestException) as err:
+            logging.warning("Can't check whether the space has ended: %s", err)
+            return False
+        return state != "Running"
+
+    def fetch_segment(self, segment: Segment) -> bytes:
+        """Download the content of a segment, through the segment cache if any"""
+
+        def fetch() -> bytes:
+            return API.client.get(segment.url, limiter=self.limiter).content
+
+        if self.cache is None:
+            return fetch()
+        return self.cache.get(self.master_url, segment.name, fetch)
+
     def write_playlist(self, save_dir: str = "./") -> None:
         """Write the modified playlist for external use"""
         filename = os.path.basename(self.filename) + ".m3u8"
@@ -83,11 +329,230 @@ class TwspaceDL:
             stream_io.write(self.playlist_text)
         logging.debug("%(path)s written to disk", dict(path=path))
 
-    def download(self) -> None:
-        """Download a twitter space"""
+    def download(self, cover: bool = False) -> None:
+        """Download a twitter space
+
+        With the built-in remuxer, the cover art is written along with the audio,
+        otherwise it is embedded afterwards with `embed_cover`.
+        """
+        has_range = self.start > 0 or self.end is not None
+        if self.use_ffmpeg and has_range:
+            raise ValueError("Time ranges are only supported by the built-in remuxer")
+        if self.use_ffmpeg and self.upload is not None:
+            raise ValueError("Uploads are only supported by the built-in remuxer")
+        if self.waveform and (self.use_ffmpeg or self.upload is not None):
+            raise ValueError("Waveforms are only written for local built-in remuxes")
+        if self.use_ffmpeg:
+            self._download_ffmpeg()
+            if cover:
+                self.embed_cover()
+            self._postprocess()
+            return
+        writer_class = MP4_WRITERS[self.layout]
+        if self.upload is not None:
+            if writer_class.seekable:
+                raise ValueError(
+                    f"The {self.layout} MP4 layout can't be uploaded, "
+                    "use faststart or fragmented"
+                )
+            upload = self.upload.open(self.filename + ".m4a")
+            with ExitStack() as stack:
+                stack.enter_context(upload)
+                self._remux(upload, self._cover() if cover else None)
+                if self.stop_event.is_set():
+                    # the recording is cut, e.g. the job was taken over by another
+                    # host which completes the same object: leave it unfinished
+                    stack.pop_all()
+                    logging.info("Upload of %s left unfinished", upload.key)
+                    return
+            logging.info(
+                "Finished uploading to %s", self.upload.url(self.filename + ".m4a")
+            )
+            return
+        self._tempdir = tempfile.mkdtemp(dir=".")
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        if writer_class.streamable:
+            # write in place so that the file can be played while recording
+            filename = self.filename + ".m4a"
+        else:
+            filename = os.path.join(
+                self._tempdir, os.path.basename(self.filename) + ".m4a"
+            )
+        resume = not has_range and self._prepare_resume(filename)
+        # a file written in place is valid after each segment, even if killed
+        self._journal_in_place = writer_class.streamable and not has_range
+        try:
+            with open(filename, "r+b" if resume else "wb") as output_file:
+                self._remux(output_file, self._cover() if cover else None, resume)
+        except KeyboardInterrupt:
+            self._save_partial(filename)
+            raise
+        except RemuxError as err:
+            if has_range or not shutil.which("ffmpeg"):
+                raise
+            logging.warning("Built-in remuxer failed (%s), retrying with ffmpeg", err)
+            self.cleanup()
+            # ffmpeg overwrites the recording, which can't be resumed anymore
+            for path in (self.journal_path, self.waveform_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._download_ffmpeg()
+            if cover:
+                self.embed_cover()
+            self._postprocess()
+            return
+        if self.stop_event.is_set():
+            self._save_partial(filename)
+            return
+        if filename != self.filename + ".m4a":
+            shutil.move(filename, self.filename + ".m4a")
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        logging.info("Finished downloading")
+        self._postprocess()
+
+    def _postprocess(self) -> None:
+        """Queue the finished recording for post-processing, without waiting for it"""
+        if self.postprocessor is not None:
+            self.postprocessor.submit(self.filename + ".m4a", self.space)
+
+    def _remux(
+        self,
+        output: BinaryFile,
+        cover: tuple[bytes, int] | None = None,
+        resume: bool = False,
+    ) -> None:
+        """Download all the segments and remux them to the specified file
+
+        When interrupted, the audio written so far is finalized into a valid file.
+        """
+        writer_class = MP4_WRITERS[self.layout]
+        writer = writer_class(output, self.tags, cover)
+        if resume:
+            try:
+                writer.resume()
+                logging.info("Resuming the recording after %.3fs", writer.duration)
+            except RemuxError as err:
+                logging.warning("Can't resume the recording (%s), starting over", err)
+                output.seek(0)
+                output.truncate()
+                self._last_sequence = -1
+                self._last_segment = ""
+                writer = writer_class(output, self.tags, cover)
+                resume = False
+        if self.waveform:
+            self._waveform = self._open_waveform(resume)
+        try:
+            if self.start > 0 or self.end is not None:
+                self._write_range(writer)
+            else:
+                for segment in self.iter_segments():
+                    logging.debug("Downloading %s", segment.name)
+                    frames = parse_adts(self.fetch_segment(segment))
+                    self._write_frames(writer, segment, frames)
+        except KeyboardInterrupt:
+            # uploads are left unfinished to be resumed instead
+            if writer.config is not None and self.upload is None:
+                logging.info("Interrupted, finalizing the recording")
+                writer.close()
+                self._save_waveform(writer)
+            raise
+        finally:
+            if self._waveform is not None:
+                self._waveform.close()
+        writer.close()
+        self._save_waveform(writer)
+        logging.debug("Remuxed %.3f seconds of audio", writer.duration)
+
+    def _write_frames(
+        self, writer: MP4Writer, segment: Segment, frames: list[ADTSFrame]
+    ) -> None:
+        """Write the frames of a segment and add them to the waveform"""
+        writer.write_frames(frames)
+        if self._waveform is not None:
+            if not self._waveform.segments and writer.edit is not None:
+                self._waveform.skip = writer.edit[0]
+            self._waveform.add_segment(segment.sequence, frames)
+        self._segment_written(segment)
+
+    def _open_waveform(self, resume: bool) -> WaveformWriter | None:
+        """Start the waveform, or continue the one of the resumed recording
+
+        The waveform is only a sidecar, the recording goes on without it.
+        """
+        try:
+            if not resume:
+                return WaveformWriter(self.waveform or DEFAULT_PEAK_INTERVAL)
+            return WaveformWriter.load(self.waveform_path)
+        except (OSError, ValueError) as err:
+            logging.warning("Can't write the waveform (%s), recording without it", err)
+            return None
+
+    def _save_waveform(self, writer: MP4Writer) -> None:
+        if self._waveform is None:
+            return
+        self._waveform.close()
+        length = writer.presentation_duration if writer.edit else None
+        self._waveform.save(self.waveform_path, writer.chunk_positions(), length)
+
+    def _write_range(self, writer: MP4Writer) -> None:
+        """Download and write only the segments covering the time range
+
+        The segment durations of the playlist are used as the timeline of the space.
+        """
+        segment_start = 0.0
+        for segment in self.iter_segments():
+            if self.end is not None and segment_start >= self.end:
+                break
+            segment_end = segment_start + segment.duration
+            if segment_end > self.start:
+                logging.debug("Downloading %s", segment.name)
+                frames = parse_adts(self.fetch_segment(segment))
+                self._write_frames(
+                    writer,
+                    segment,
+                    self._frames_in_range(writer, frames, segment_start),
+                )
+            segment_start = segment_end
+
+    def _frames_in_range(
+        self, writer: MP4Writer, frames: list[ADTSFrame], segment_start: float
+    ) -> list[ADTSFrame]:
+        """Select the frames of a segment overlapping the time range
+
+        One frame before the range is kept as decoder pre-roll, the writer is trimmed
+        to the exact samples of the range when the first frame is selected.
+        """
+        if not frames:
+            return frames
+        sample_rate = frames[0].config.sample_rate
+        start = round(self.start * sample_rate)
+        end = None if self.end is None else round(self.end * sample_rate)
+        first_sample = round(segment_start * sample_rate)
+        selected = []
+        for index, frame in enumerate(frames):
+            frame_start = first_sample + index * SAMPLES_PER_FRAME
+            if frame_start + 2 * SAMPLES_PER_FRAME <= start:
+                continue
+            if end is not None and frame_start >= end:
+                break
+            if writer.edit is None:
+                writer.trim(
+                    max(start - frame_start, 0),
+                    None if end is None else end - max(start, frame_start),
+                )
+            selected.append(frame)
+        return selected
+
+    def _download_ffmpeg(self) -> None:
+        """Download a twitter space using ffmpeg"""
         if not shutil.which("ffmpeg"):
             raise FileNotFoundError("ffmpeg not installed")
+        if self.limiter or API.client.limiter or API.client.host_limiters:
+            logging.warning("ffmpeg downloads the segments without the rate limits")
         space = self.space
+        env = self._ffmpeg_env()
         self._tempdir = tempfile.mkdtemp(dir=".")
         self.write_playlist(save_dir=self._tempdir)
         state = space["state"]
@@ -146,14 +611,14 @@ class TwspaceDL:
             logging.debug("Command for the new part: %s", " ".join(cmd_new))
             logging.debug("Command for the merge: %s", " ".join(cmd_final))
             try:
-                subprocess.run(cmd_new, check=True)
-                subprocess.run(cmd_old, check=True)
+                self._record_ffmpeg(cmd_new, filename_new, env)
+                subprocess.run(cmd_old, check=True, env=env)
                 subprocess.run(cmd_final, check=True)
             except subprocess.CalledProcessError as err:
                 raise RuntimeError(" ".join(err.cmd)) from err
         else:
             try:
-                subprocess.run(cmd_old, check=True)
+                subprocess.run(cmd_old, check=True, env=env)
             except subprocess.CalledProcessError as err:
                 raise RuntimeError(
                     " ".join(err.cmd)
@@ -165,23 +630,46 @@ class TwspaceDL:
 
         logging.info("Finished downloading")
 
+    def _cover(self) -> tuple[bytes, int] | None:
+        """Download the user profile image and return it with its MP4 cover format"""
+        return download_cover(self.space["creator_profile_image_url"])
+
     def embed_cover(self) -> None:
         """Embed the user profile image as the cover art"""
-        cover_url = self.space["creator_profile_image_url"]
-        cover_ext = cover_url.split(".")[-1]
+        if cover := self._cover():
+            content, cover_format = cover
+            meta = MP4(f"{self.filename}.m4a")
+            meta.tags["covr"] = [MP4Cover(content, imageformat=cover_format)]
+            meta.save()
+
+    def _ffmpeg_env(self) -> dict[str, str] | None:
+        """Environment making ffmpeg go through the fastest proxy of the pool, if any"""
+        if not API.client.proxies:
+            return None
+        return {**os.environ, "http_proxy": API.client.proxies.best().url}
+
+    def _record_ffmpeg(
+        self, cmd: list[str], filename: str, env: dict[str, str] | None = None
+    ) -> None:
+        """Record the live part with ffmpeg, keeping it if interrupted"""
+        process = subprocess.Popen(cmd, env=env)
         try:
-            response = API.client.get(cover_url)
-            if cover_format := MP4_COVER_FORMAT_MAP.get(cover_ext):
-                meta = MP4(f"{self.filename}.m4a")
-                meta.tags["covr"] = [
-                    MP4Cover(response.content, imageformat=cover_format)
-                ]
-                meta.save()
-            else:
-                logging.error(f"Unsupported user profile image format: {cover_ext}")
-        except RuntimeError:
-            logging.error(f"Cannot download user profile image from URL: {cover_url}")
+            returncode = process.wait()
+        except KeyboardInterrupt:
+            # let ffmpeg finalize its output, it may not have received the signal
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(FFMPEG_FINALIZE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            if os.path.exists(filename) and os.path.getsize(filename):
+                shutil.move(filename, self.filename + "_live.m4a")
+                logging.info(
+                    "Saved the live part recorded so far to %s_live.m4a", self.filename
+                )
             raise
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
 
     def cleanup(self) -> None:
         if os.path.exists(self._tempdir):
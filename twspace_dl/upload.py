@@ -0,0 +1,457 @@
+"""Stream recordings to S3-compatible object storage with multipart uploads"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import hmac
+import io
+import logging
+import os
+import xml.etree.ElementTree as ET
+from types import TracebackType
+from typing import NamedTuple
+from urllib.parse import quote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .api import RETRY
+
+"""Size of the parts uploaded while recording, about 15 minutes of audio."""
+DEFAULT_PART_SIZE = 8 * 1024**2
+
+"""Minimum size of all the parts but the last one, imposed by S3."""
+MIN_PART_SIZE = 5 * 1024**2
+
+"""Connection timeout of the requests to the object storage."""
+S3_TIMEOUT = 60
+
+"""Region used when none is configured, most S3-compatible servers ignore it."""
+DEFAULT_REGION = "us-east-1"
+
+
+class S3Error(RuntimeError):
+    """Raised when the object storage rejects a request."""
+
+
+def parse_s3_url(url: str) -> tuple[str, str]:
+    """Split an `s3://bucket/prefix` URL.
+
+    - return: The bucket and the key prefix (possibly empty).
+
+    - raise ValueError: If the URL is not an `s3://` URL with a bucket.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != "s3" or not parsed.netloc:
+        raise ValueError(f"Invalid S3 URL: {url}")
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def _find(element: ET.Element, tag: str) -> str:
+    # S3 responses are namespaced, MinIO and others sometimes aren't
+    return element.findtext(f"{{*}}{tag}") or element.findtext(tag) or ""
+
+
+def _findall(element: ET.Element, tag: str) -> list[ET.Element]:
+    return element.findall(f"{{*}}{tag}") or element.findall(tag)
+
+
+class S3Client:
+    """Minimal client of the S3 API, signing requests with AWS Signature Version 4.
+
+    Buckets are addressed in the path (`endpoint/bucket/key`), which all the
+    S3-compatible servers support.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        region: str = DEFAULT_REGION,
+        session_token: str | None = None,
+    ) -> None:
+        """Initialize the client.
+
+        - endpoint: The base URL of the server, e.g. `http://localhost:9000`.
+        - access_key: The access key ID.
+        - secret_key: The secret access key.
+        - region: The region of the bucket.
+        - session_token: The token of temporary credentials, if any.
+        """
+        self.endpoint = endpoint.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session_token = session_token
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(max_retries=RETRY))
+        self.session.mount("http://", HTTPAdapter(max_retries=RETRY))
+
+    @classmethod
+    def from_env(cls, endpoint: str | None = None) -> S3Client:
+        """Create a client from the usual `AWS_*` environment variables.
+
+        - endpoint: The base URL of the server, defaults to `AWS_ENDPOINT_URL` or AWS.
+
+        - raise ValueError: If the credentials are missing.
+        """
+        access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+        secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+        if not access_key or not secret_key:
+            raise ValueError(
+                "AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set to upload"
+            )
+        region = (
+            os.environ.get("AWS_REGION")
+            or os.environ.get("AWS_DEFAULT_REGION")
+            or DEFAULT_REGION
+        )
+        endpoint = (
+            endpoint
+            or os.environ.get("AWS_ENDPOINT_URL")
+            or f"https://s3.{region}.amazonaws.com"
+        )
+        return cls(
+            endpoint,
+            access_key,
+            secret_key,
+            region,
+            os.environ.get("AWS_SESSION_TOKEN"),
+        )
+
+    def _signing_key(self, date: str) -> bytes:
+        key = ("AWS4" + self.secret_key).encode("utf-8")
+        for message in (date, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+        return key
+
+    def sign(
+        self,
+        method: str,
+        path: str,
+        query: str,
+        headers: dict[str, str],
+        payload_hash: str,
+        now: datetime.datetime,
+    ) -> str:
+        """Compute the `Authorization` header of a request.
+
+        - path: The URI-encoded path of the request.
+        - query: The canonical query string of the request.
+        - headers: All the headers to sign, including `host` and `x-amz-date`.
+        - payload_hash: The hex SHA-256 of the body.
+        - now: The time of the request, in UTC.
+        """
+        date = now.strftime("%Y%m%d")
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        names = sorted(name.lower() for name in headers)
+        lower_headers = {name.lower(): value for name, value in headers.items()}
+        canonical_headers = "".join(
+            f"{name}:{lower_headers[name].strip()}\n" for name in names
+        )
+        signed_headers = ";".join(names)
+        canonical_request = "\n".join(
+            (method, path, query, canonical_headers, signed_headers, payload_hash)
+        )
+        string_to_sign = "\n".join(
+            (
+                "AWS4-HMAC-SHA256",
+                now.strftime("%Y%m%dT%H%M%SZ"),
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            )
+        )
+        signature = hmac.new(
+            self._signing_key(date), string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        return (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+
+    def request(
+        self,
+        method: str,
+        bucket: str,
+        key: str = "",
+        params: dict[str, str] | None = None,
+        data: bytes = b"",
+        headers: dict[str, str] | None = None,
+    ) -> requests.Response:
+        """Send a signed request.
+
+        - raise S3Error: If the request failed.
+        """
+        path = quote(f"/{bucket}/{key}" if key else f"/{bucket}", safe="/-_.~")
+        query = "&".join(
+            f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+            for name, value in sorted((params or {}).items())
+        )
+        now = datetime.datetime.now(datetime.timezone.utc)
+        payload_hash = hashlib.sha256(data).hexdigest()
+        headers = {
+            **(headers or {}),
+            "host": urlparse(self.endpoint).netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": now.strftime("%Y%m%dT%H%M%SZ"),
+        }
+        if self.session_token:
+            headers["x-amz-security-token"] = self.session_token
+        headers["authorization"] = self.sign(
+            method, path, query, headers, payload_hash, now
+        )
+        url = self.endpoint + path + (f"?{query}" if query else "")
+        try:
+            response = self.session.request(
+                method, url, data=data, headers=headers, timeout=S3_TIMEOUT
+            )
+        except requests.RequestException as err:
+            raise S3Error(f"{method} {url} failed: {err}") from err
+        if response.status_code >= 300:
+            message = response.text
+            try:
+                message = _find(ET.fromstring(response.content), "Message") or message
+            except ET.ParseError:
+                pass
+            raise S3Error(f"{method} {url} failed ({response.status_code}): {message}")
+        return response
+
+    def create_multipart_upload(
+        self, bucket: str, key: str, content_type: str = "audio/mp4"
+    ) -> str:
+        """Start a multipart upload and return its ID."""
+        response = self.request(
+            "POST",
+            bucket,
+            key,
+            {"uploads": ""},
+            headers={"content-type": content_type},
+        )
+        return _find(ET.fromstring(response.content), "UploadId")
+
+    def find_multipart_upload(self, bucket: str, key: str) -> str | None:
+        """Return the ID of the latest unfinished multipart upload of a key, if any."""
+        response = self.request("GET", bucket, params={"uploads": "", "prefix": key})
+        uploads = [
+            (_find(upload, "Initiated"), _find(upload, "UploadId"))
+            for upload in _findall(ET.fromstring(response.content), "Upload")
+            if _find(upload, "Key") == key
+        ]
+        return max(uploads)[1] if uploads else None
+
+    def list_parts(self, bucket: str, key: str, upload_id: str) -> dict[int, str]:
+        """Return the ETags of the parts already uploaded, by part number."""
+        parts = {}
+        marker = "0"
+        while True:
+            response = self.request(
+                "GET",
+                bucket,
+                key,
+                {"uploadId": upload_id, "part-number-marker": marker},
+            )
+            root = ET.fromstring(response.content)
+            for part in _findall(root, "Part"):
+                parts[int(_find(part, "PartNumber"))] = _find(part, "ETag").strip('"')
+            if _find(root, "IsTruncated") != "true":
+                return parts
+            marker = _find(root, "NextPartNumberMarker")
+
+    def upload_part(
+        self, bucket: str, key: str, upload_id: str, number: int, data: bytes
+    ) -> str:
+        """Upload a part and return its ETag."""
+        response = self.request(
+            "PUT",
+            bucket,
+            key,
+            {"partNumber": str(number), "uploadId": upload_id},
+            data,
+        )
+        return response.headers.get("ETag", "").strip('"')
+
+    def complete_multipart_upload(
+        self, bucket: str, key: str, upload_id: str, parts: dict[int, str]
+    ) -> None:
+        """Assemble the uploaded parts into the final object."""
+        body = "".join(
+            f'<Part><PartNumber>{number}</PartNumber><ETag>"{etag}"</ETag></Part>'
+            for number, etag in sorted(parts.items())
+        )
+        response = self.request(
+            "POST",
+            bucket,
+            key,
+            {"uploadId": upload_id},
+            f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode(),
+        )
+        # errors can also be reported with a 200 status once the parts are assembled
+        if _find(ET.fromstring(response.content), "Code"):
+            raise S3Error(f"Cannot complete the upload of {key}: {response.text}")
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        """Abort a multipart upload and delete its parts."""
+        self.request("DELETE", bucket, key, {"uploadId": upload_id})
+
+
+class MultipartUpload:
+    """Write-only binary file uploading its content as the parts of a multipart upload.
+
+    Nothing is written to disk: data is buffered in memory until a part is full.
+    When `resume` is set, an unfinished upload of the same key is continued, and the
+    parts it already has are not uploaded again if they have the same content, which
+    is the case when the same recording is written again.
+
+    Used as a context manager, the upload is completed if the context exits normally,
+    otherwise it is left unfinished to be resumed.
+    """
+
+    def __init__(
+        self,
+        client: S3Client,
+        bucket: str,
+        key: str,
+        part_size: int = DEFAULT_PART_SIZE,
+        resume: bool = True,
+    ) -> None:
+        """Start or resume the upload.
+
+        - client: The client of the object storage.
+        - bucket: The bucket to upload to.
+        - key: The key of the object.
+        - part_size: The size of the parts, at least `MIN_PART_SIZE`.
+        - resume: Continue an unfinished upload of the same key, if any.
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"Parts must be at least {MIN_PART_SIZE} bytes")
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.parts: dict[int, str] = {}
+        self.skipped_parts = 0
+        self._uploaded: dict[int, str] = {}
+        self._buffer = bytearray()
+        self._position = 0
+        self.closed = False
+        upload_id = client.find_multipart_upload(bucket, key) if resume else None
+        if upload_id is not None:
+            self._uploaded = client.list_parts(bucket, key, upload_id)
+            logging.info(
+                "Resuming the upload of %s (%d parts uploaded)",
+                key,
+                len(self._uploaded),
+            )
+        else:
+            upload_id = client.create_multipart_upload(bucket, key)
+        self.upload_id = upload_id
+
+    def __enter__(self) -> MultipartUpload:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        _e: BaseException | None,
+        _t: TracebackType | None,
+    ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            logging.info("Upload of %s left unfinished to be resumed", self.key)
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        raise io.UnsupportedOperation("Uploads are write-only")
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        raise io.UnsupportedOperation("Uploads are written sequentially")
+
+    def truncate(self, size: int | None = None) -> int:
+        raise io.UnsupportedOperation("Uploads are written sequentially")
+
+    def write(self, data: bytes) -> int:
+        """Buffer data, uploading parts as they are full."""
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def flush(self) -> None:
+        # parts can't be smaller than MIN_PART_SIZE, data is uploaded by `write`
+        pass
+
+    def _upload_part(self, data: bytes) -> None:
+        number = len(self.parts) + 1
+        etag = self._uploaded.get(number)
+        if etag is not None and etag == hashlib.md5(data).hexdigest():
+            self.skipped_parts += 1
+        else:
+            etag = self.client.upload_part(
+                self.bucket, self.key, self.upload_id, number, data
+            )
+        self.parts[number] = etag
+        logging.debug("Uploaded part %d of %s", number, self.key)
+
+    def close(self) -> None:
+        """Upload the last part and complete the upload."""
+        if self.closed:
+            return
+        if self._buffer or not self.parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        self.client.complete_multipart_upload(
+            self.bucket, self.key, self.upload_id, self.parts
+        )
+        self.closed = True
+
+    def abort(self) -> None:
+        """Abort the upload, deleting the parts already uploaded."""
+        self.client.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+        self.closed = True
+
+
+class S3Output(NamedTuple):
+    """Destination of the recordings in an S3-compatible object storage."""
+
+    client: S3Client
+    bucket: str
+    prefix: str = ""
+    part_size: int = DEFAULT_PART_SIZE
+
+    @classmethod
+    def from_url(
+        cls, url: str, client: S3Client, part_size: int = DEFAULT_PART_SIZE
+    ) -> S3Output:
+        """Create the destination of an `s3://bucket/prefix` URL."""
+        bucket, prefix = parse_s3_url(url)
+        return cls(client, bucket, prefix, part_size)
+
+    def key(self, filename: str) -> str:
+        """Return the key of the object storing a file of the recording."""
+        filename = os.path.normpath(filename).replace(os.sep, "/").lstrip("/")
+        if not self.prefix:
+            return filename
+        return self.prefix.rstrip("/") + "/" + filename
+
+    def open(self, filename: str) -> MultipartUpload:
+        """Start or resume the upload of a file of the recording."""
+        return MultipartUpload(
+            self.client, self.bucket, self.key(filename), self.part_size
+        )
+
+    def url(self, filename: str) -> str:
+        """Return the `s3://` URL of a file of the recording."""
+        return f"s3://{self.bucket}/{self.key(filename)}"
@@ -0,0 +1,256 @@
+"""Verify archived recordings against the playlist of their space"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, NamedTuple
+
+from mutagen import MutagenError
+from mutagen.mp4 import MP4
+
+from .api import API
+from .remux import iter_boxes, iter_file_boxes
+from .twspace import Twspace
+from .twspace_dl import TwspaceDL
+
+"""Default difference in seconds tolerated between a file and its playlist."""
+DEFAULT_TOLERANCE = 1.0
+
+
+class MP4Info(NamedTuple):
+    """Summary of the audio track of an MP4 file, read from its sample tables."""
+
+    sample_count: int
+    duration: int
+    timescale: int
+    # chunks of a regular file, fragments of a fragmented one
+    chunk_count: int
+    fragmented: bool
+    truncated: bool
+    # the track has an edit list, e.g. a clip recorded with `--start` or `--end`
+    edited: bool = False
+
+    @property
+    def seconds(self) -> float:
+        return self.duration / self.timescale if self.timescale else 0.0
+
+
+class VerifyResult(NamedTuple):
+    """Outcome of the verification of a file."""
+
+    path: str
+    status: str
+    message: str
+    segments: int = 0
+    chunks: int = 0
+    expected: float = 0.0
+    actual: float = 0.0
+
+
+def _read_trak(data: bytes) -> tuple[bool, int, int, int, int]:
+    """Read the handler, timescale, sample count, duration and chunk count of a trak."""
+    boxes = dict(iter_boxes(data, {b"mdia", b"minf", b"stbl"}))
+    handler = boxes.get(b"hdlr", b"")[8:12]
+    mdhd = boxes.get(b"mdhd", b"")
+    if mdhd[:1] == b"\x01":
+        timescale = struct.unpack_from(">I", mdhd, 20)[0]
+    else:
+        timescale = struct.unpack_from(">I", mdhd, 12)[0] if len(mdhd) >= 16 else 0
+    samples = duration = 0
+    stts = boxes.get(b"stts", b"")
+    if len(stts) >= 8:
+        (entries,) = struct.unpack_from(">I", stts, 4)
+        for index in range(entries):
+            count, delta = struct.unpack_from(">II", stts, 8 + index * 8)
+            samples += count
+            duration += count * delta
+    chunks = 0
+    for kind in (b"stco", b"co64"):
+        if len(boxes.get(kind, b"")) >= 8:
+            (chunks,) = struct.unpack_from(">I", boxes[kind], 4)
+    return handler == b"soun", timescale, samples, duration, chunks
+
+
+def _read_traf(payload: bytes, default_duration: int) -> tuple[int, int]:
+    """Read the sample count and duration of a track fragment."""
+    samples = duration = 0
+    for kind, box in iter_boxes(payload):
+        if kind == b"tfhd":
+            (flags,) = struct.unpack_from(">I", box, 0)
+            offset = 8
+            if flags & 0x01:
+                offset += 8
+            if flags & 0x02:
+                offset += 4
+            if flags & 0x08:
+                (default_duration,) = struct.unpack_from(">I", box, offset)
+        elif kind == b"trun":
+            flags, count = struct.unpack_from(">II", box, 0)
+            offset = 8 + 4 * bool(flags & 0x01) + 4 * bool(flags & 0x04)
+            fields = sum(bool(flags & flag) for flag in (0x100, 0x200, 0x400, 0x800))
+            samples += count
+            if flags & 0x100:
+                for index in range(count):
+                    duration += struct.unpack_from(
+                        ">I", box, offset + index * 4 * fields
+                    )[0]
+            else:
+                duration += count * default_duration
+    return samples, duration
+
+
+def read_mp4_info(path: str) -> MP4Info:
+    """Read the sample tables of the audio track of an MP4 file.
+
+    Regular files are summarized from `moov`, fragmented files from all their `moof`
+    boxes. Only the boxes describing the samples are read, not the audio data.
+
+    - raise ValueError: If the file has no audio track.
+    """
+    timescale = samples = duration = chunks = 0
+    default_duration = 0
+    fragmented = truncated = found = edited = False
+    with open(path, "rb") as mp4_io:
+        end = os.fstat(mp4_io.fileno()).st_size
+        for kind, start, stop, cut in iter_file_boxes(mp4_io, 0, end):
+            truncated = truncated or cut
+            if kind not in (b"moov", b"moof") or cut:
+                continue
+            mp4_io.seek(start)
+            payload = mp4_io.read(stop - start)
+            if kind == b"moof":
+                fragmented = True
+                chunks += 1
+                for traf_kind, traf in iter_boxes(payload):
+                    if traf_kind == b"traf":
+                        traf_samples, traf_duration = _read_traf(traf, default_duration)
+                        samples += traf_samples
+                        duration += traf_duration
+                continue
+            for trak_kind, box in iter_boxes(payload, {b"mvex"}):
+                if trak_kind == b"trex" and len(box) >= 16:
+                    (default_duration,) = struct.unpack_from(">I", box, 12)
+                elif trak_kind == b"trak" and not found:
+                    found, timescale, samples, duration, chunks = _read_trak(box)
+                    edited = b"elst" in dict(iter_boxes(box, {b"edts"}))
+    if not found:
+        raise ValueError("No audio track")
+    return MP4Info(samples, duration, timescale, chunks, fragmented, truncated, edited)
+
+
+def iter_recordings(*paths: str) -> Iterator[str]:
+    """Find the `.m4a` files in files and directory trees."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, _, files in sorted(os.walk(path)):
+            for file in sorted(files):
+                if file.endswith(".m4a"):
+                    yield os.path.join(root, file)
+
+
+def _load_space(path: str) -> Twspace:
+    """Load the current state of the space of a recording.
+
+    The space ID is read from the metadata file of the recording, or from its tags.
+    The metadata file is a snapshot of when the recording started, so the space is
+    always requested again: a space recorded live is saved as running.
+    """
+    metadata_path = os.path.splitext(path)[0] + ".json"
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r", encoding="utf-8") as metadata_io:
+            metadata = json.load(metadata_io)
+        space_id = metadata["data"]["audioSpace"]["metadata"]["rest_id"]
+    else:
+        try:
+            tags = MP4(path).tags
+        except MutagenError as err:
+            raise ValueError(f"Cannot read the tags: {err}") from err
+        episode_ids = tags.get("tven") if tags is not None else None
+        space_id = episode_ids[0] if episode_ids else ""
+    if not space_id:
+        raise ValueError(f"No space ID in {os.path.basename(metadata_path)} or tags")
+    return Twspace.from_space_url(f"https://x.com/i/spaces/{space_id}")
+
+
+def verify_recording(path: str, tolerance: float = DEFAULT_TOLERANCE) -> VerifyResult:
+    """Compare a recording with the media playlist of its space.
+
+    Only the playlist is downloaded. Recordings of the built-in remuxer store each
+    segment as one chunk or fragment, so missing segments are also detected by
+    count; other files are compared by duration only. Clips recorded with `--start`
+    or `--end` have an edit list and are not compared.
+
+    - path: The path of the `.m4a` file. The space is found with the metadata file
+      written next to it by `--write-metadata`, or with the space ID tag of the file.
+    - tolerance: The difference in seconds tolerated between the file and the
+      playlist.
+    """
+    try:
+        info = read_mp4_info(path)
+    except (OSError, ValueError, struct.error) as err:
+        return VerifyResult(path, "corrupt", str(err))
+    if info.edited and not info.truncated:
+        # where the clip starts in the space isn't stored in the file
+        return VerifyResult(
+            path, "skipped", "clip of a time range, the duration isn't checked"
+        )
+    try:
+        space = _load_space(path)
+        if space["state"] == "Running":
+            return VerifyResult(path, "skipped", "space is still running")
+        playlist = TwspaceDL(space, "").media_playlist
+    except (OSError, ValueError, KeyError, RuntimeError) as err:
+        return VerifyResult(path, "error", f"Cannot get the playlist: {err}")
+    expected = sum(segment.duration for segment in playlist.segments)
+    segments = len(playlist.segments)
+    result = VerifyResult(
+        path, "ok", "", segments, info.chunk_count, expected, info.seconds
+    )
+    if info.truncated:
+        return result._replace(status="truncated", message="the file is cut")
+    difference = info.seconds - expected
+    if abs(difference) <= tolerance:
+        return result
+    missing = ""
+    if info.chunk_count < segments:
+        missing = f", {segments - info.chunk_count} segments missing?"
+    return result._replace(
+        status="short" if difference < 0 else "long",
+        message=f"{info.seconds:.3f}s instead of {expected:.3f}s{missing}",
+    )
+
+
+def _init_worker(cookies: list[dict], strategy: str) -> None:
+    # workers may be spawned rather than forked, without the APIs of the parent
+    API.init_apis(cookies, strategy)
+
+
+def verify_recordings(
+    paths: list[str],
+    cookies: list[dict],
+    strategy: str = "round-robin",
+    tolerance: float = DEFAULT_TOLERANCE,
+    workers: int | None = None,
+) -> Iterator[VerifyResult]:
+    """Verify recordings in parallel with a process pool.
+
+    - paths: The recordings, or directories searched recursively for `.m4a` files.
+    - cookies: The cookies of the accounts used to get the playlists.
+    - strategy: The strategy of the account pool, see `ACCOUNT_STRATEGIES`.
+    - tolerance: The difference in seconds tolerated between a file and its playlist.
+    - workers: The number of processes, defaults to the number of CPUs.
+
+    - return: An iterator over the results, in the order of the files.
+    """
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(cookies, strategy)
+    ) as executor:
+        recordings = list(iter_recordings(*paths))
+        yield from executor.map(
+            verify_recording, recordings, [tolerance] * len(recordings)
+        )
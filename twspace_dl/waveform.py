@@ -0,0 +1,250 @@
+"""Waveform peaks and seek index of a recording, computed while it is written"""
+
+from __future__ import annotations
+
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import threading
+from array import array
+from typing import Any, Sequence
+
+from .remux import SAMPLES_PER_FRAME, ADTSFrame
+
+"""Default milliseconds of audio summarized by each peak."""
+DEFAULT_PEAK_INTERVAL = 100
+
+"""Size of the reads of the decoded audio."""
+DECODE_CHUNK_SIZE = 64 * 1024
+
+
+def adts_frame(frame: ADTSFrame) -> bytes:
+    """Put back the ADTS header of a frame, without CRC."""
+    config = frame.config
+    length = len(frame.payload) + 7
+    header = bytes(
+        (
+            0xFF,
+            0xF1,
+            (config.object_type - 1) << 6
+            | config.sampling_index << 2
+            | config.channel_config >> 2,
+            (config.channel_config & 0x03) << 6 | length >> 11,
+            length >> 3 & 0xFF,
+            (length & 0x07) << 5 | 0x1F,
+            0xFC,
+        )
+    )
+    return header + frame.payload
+
+
+class WaveformWriter:
+    """Peaks of the audio and start offsets of the segments of a recording.
+
+    The frames of each segment are decoded by an ffmpeg process as they are written,
+    and each `interval` of decoded samples is reduced to its minimum and maximum in a
+    background thread, with `min()` and `max()` over whole arrays rather than a
+    Python loop over the samples. The result is saved as JSON in the format of
+    [audiowaveform](https://github.com/bbc/audiowaveform), with the seek index of the
+    segments added as `segments`.
+    """
+
+    def __init__(self, interval: int = DEFAULT_PEAK_INTERVAL) -> None:
+        """Initialize the writer, the decoder is started with the first segment.
+
+        - interval: The milliseconds of audio summarized by each peak.
+
+        - raise FileNotFoundError: If ffmpeg is not installed.
+        """
+        if not shutil.which("ffmpeg"):
+            raise FileNotFoundError("ffmpeg not installed")
+        self.interval = interval
+        self.sample_rate = 0
+        # minimum and maximum of each interval, 8 bits
+        self.peaks = array("b")
+        # sequence number and first sample of each segment
+        self.segments: list[tuple[int, int]] = []
+        # samples before the start of the presentation, see `MP4Writer.trim()`
+        self.skip = 0
+        self._written = 0
+        self._decoded = 0
+        self._low = self._high = 0
+        self._decoder: subprocess.Popen | None = None
+        self._reader: threading.Thread | None = None
+        self._failed = False
+
+    @property
+    def samples_per_peak(self) -> int:
+        return max(self.sample_rate * self.interval // 1000, 1)
+
+    def add_segment(self, sequence: int, frames: Sequence[ADTSFrame]) -> None:
+        """Record a segment written as a chunk of the recording and decode its frames.
+
+        - sequence: The media sequence number of the segment.
+        - frames: The frames written.
+        """
+        if not frames:
+            return
+        self.segments.append((sequence, self._written))
+        self._written += len(frames) * SAMPLES_PER_FRAME
+        if self._failed:
+            return
+        if self._decoder is None:
+            self.sample_rate = frames[0].config.sample_rate
+            try:
+                self._start()
+            except OSError as err:
+                self._fail(err)
+                return
+        assert self._decoder is not None and self._decoder.stdin is not None
+        try:
+            self._decoder.stdin.write(b"".join(map(adts_frame, frames)))
+        except OSError as err:
+            self._fail(err)
+
+    def _start(self) -> None:
+        # the channels are mixed down, peaks are computed on 16-bit samples
+        cmd = ["ffmpeg", "-v", "error", "-f", "aac", "-i", "pipe:0"]
+        cmd += ["-ac", "1", "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"]
+        # in its own session so that a Ctrl+C, which finalizes the recording, doesn't
+        # kill it too: it stops at the end of its input, when closed
+        self._decoder = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True
+        )
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _fail(self, err: Exception) -> None:
+        logging.warning("Cannot decode the audio for the waveform: %s", err)
+        self._failed = True
+
+    def _read(self) -> None:
+        """Reduce the decoded samples to peaks, in the background thread."""
+        assert self._decoder is not None and self._decoder.stdout is not None
+        stdout = self._decoder.stdout
+        leftover = b""
+        while chunk := stdout.read(DECODE_CHUNK_SIZE):
+            chunk = leftover + chunk
+            even = len(chunk) & ~1
+            samples = array("h", chunk[:even])
+            leftover = chunk[even:]
+            if sys.byteorder == "big":
+                samples.byteswap()
+            self._reduce(samples)
+
+    def _reduce(self, samples: array) -> None:
+        size = self.samples_per_peak
+        start = 0
+        if self._decoded < self.skip:
+            start = min(self.skip - self._decoded, len(samples))
+            self._decoded += start
+        position = self._decoded - self.skip
+        while start < len(samples):
+            offset = position % size
+            stop = min(start + size - offset, len(samples))
+            window = samples[start:stop]
+            low, high = min(window), max(window)
+            if offset:
+                low, high = min(low, self._low), max(high, self._high)
+            self._low, self._high = low, high
+            position += stop - start
+            self._decoded += stop - start
+            start = stop
+            if position % size == 0:
+                self.peaks.extend((low >> 8, high >> 8))
+
+    def close(self) -> None:
+        """Wait for the decoding of all the written segments."""
+        if self._decoder is None:
+            return
+        assert self._decoder.stdin is not None and self._reader is not None
+        try:
+            self._decoder.stdin.close()
+        except OSError:
+            pass
+        self._reader.join()
+        if self._decoder.wait() and not self._failed:
+            self._fail(RuntimeError(f"ffmpeg exited with {self._decoder.returncode}"))
+        self._decoder = None
+
+    def _data(self, length: int | None) -> list[int]:
+        """The peaks, with the interval being reduced, cut to the presented samples."""
+        peaks = self.peaks.tolist()
+        if (self._decoded - self.skip) % self.samples_per_peak:
+            peaks += [self._low >> 8, self._high >> 8]
+        if length is not None:
+            peaks = peaks[: -(-length // self.samples_per_peak) * 2]
+        return peaks
+
+    def save(self, path: str, offsets: list[int], length: int | None = None) -> None:
+        """Write the waveform and the seek index, see `load()` to continue them.
+
+        - path: The path of the JSON file.
+        - offsets: The file offsets of the chunks (or fragments) of the recording,
+          see `MP4Writer.chunk_positions()`.
+        - length: The number of samples presented, if trimmed.
+        """
+        if self._failed:
+            return
+        if len(offsets) != len(self.segments):
+            logging.warning("The seek index doesn't match the recording, not saved")
+            return
+        data = self._data(length)
+        segments = [
+            {
+                "sequence": sequence,
+                "time": max(start - self.skip, 0) / self.sample_rate,
+                "offset": offset,
+            }
+            for (sequence, start), offset in zip(self.segments, offsets)
+        ]
+        waveform = {
+            "version": 2,
+            "channels": 1,
+            "sample_rate": self.sample_rate,
+            "samples_per_pixel": self.samples_per_peak,
+            "bits": 8,
+            "length": len(data) // 2,
+            "data": data,
+            "segments": segments,
+            # to continue the waveform when the recording is resumed
+            "interval": self.interval,
+            "skip": self.skip,
+            "decoded": self._decoded,
+            "written": self._written,
+        }
+        with open(path, "w", encoding="utf-8") as waveform_io:
+            json.dump(waveform, waveform_io, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> WaveformWriter:
+        """Continue the waveform of a recording being resumed.
+
+        - raise ValueError: If the file wasn't saved by `save()`.
+        """
+        with open(path, encoding="utf-8") as waveform_io:
+            waveform: dict[str, Any] = json.load(waveform_io)
+        try:
+            writer = cls(waveform["interval"])
+            writer.sample_rate = waveform["sample_rate"]
+            writer.skip = waveform["skip"]
+            writer._decoded = waveform["decoded"]
+            writer._written = waveform["written"]
+            writer.segments = [
+                (
+                    segment["sequence"],
+                    round(segment["time"] * writer.sample_rate) + writer.skip,
+                )
+                for segment in waveform["segments"]
+            ]
+            data = waveform["data"]
+        except (KeyError, TypeError) as err:
+            raise ValueError(f"Invalid waveform file: {path}") from err
+        if (writer._decoded - writer.skip) % writer.samples_per_peak:
+            # the last interval was saved unfinished, it goes on with the next samples
+            *data, low, high = data
+            writer._low, writer._high = low << 8, high << 8
+        writer.peaks = array("b", data)
+        return writer